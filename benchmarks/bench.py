@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+benchmarks of the hot paths on synthetic libraries, runs offline: the flask routes are called through the test client
+with a user put directly in the session, google login is never reached
+
+results are written as json, --compare prints the ratio to a previous result file
+"""
+import os, sys, json, argparse, tempfile, shutil, time, platform, subprocess, sqlite3
+
+benchPath = os.path.dirname(os.path.abspath(__file__))
+fotosPath = os.path.join(benchPath, '..', 'fotos')
+sys.path.insert(0, fotosPath)
+
+from library import generate_library
+
+def bench_config(root, dbFile):
+    with open(os.path.join(fotosPath, 'config-example.json')) as f:
+        config = json.load(f)
+    config['paths'] = [root]
+    config['dbFile'] = dbFile
+    config['parseJobs'] = 1
+    config['logging'] = {'version': 1, 'disable_existing_loggers': False, 'root': {'level': 'WARNING'}}
+    return config
+
+class Bench:
+    def __init__(self, repeat) -> None:
+        self.repeat = repeat
+        self.results = []
+
+    def timed(self, photos, name, fn, repeat = 1):
+        """runs fn repeat times, records the total and the per call time"""
+        start = time.perf_counter()
+        for i in range(repeat):
+            value = fn()
+        seconds = time.perf_counter() - start
+        self.results.append({'photos': photos, 'name': name, 'seconds': seconds, 'repeat': repeat, 'per_call_ms': seconds * 1000 / repeat})
+        print("%6d photos  %-24s %10.3f ms/call" % (photos, name, seconds * 1000 / repeat))
+        return value
+
+    def run(self, photos, size, workDir):
+        root = os.path.join(workDir, 'library-%d' % photos)
+        generate_library(root, 'bench', photos, size = size)
+        config = bench_config(root, os.path.join(workDir, 'album-%d.db' % photos))
+
+        #fotos reads its config at import time
+        configFile = os.path.join(workDir, 'config.json')
+        with open(configFile, 'w') as f:
+            json.dump(config, f)
+        os.environ['FOTOS_CONFIG'] = configFile
+        import fotos
+        from db import Db
+        from albumParser import AlbumParser
+        from cache import LruCache
+        fotos.config.clear()
+        fotos.config.update(config)
+        fotos.db = db = Db(config, fotos.logger)
+        fotos.parser = parser = AlbumParser(config, fotos.logger)
+        fotos.albumCache = LruCache(config.get('albumCacheSize', 100))
+
+        album = self.timed(photos, 'parse', lambda: parser.parse('bench', False))
+        self.timed(photos, 'parse_unchanged', lambda: parser.parse('bench', False))
+        self.timed(photos, 'create_album', lambda: db.create_album(json.loads(json.dumps(album, default = str))))
+        self.timed(photos, 'import_records', lambda: db.import_records(parser.iter_parse('bench', False)))
+
+        tags = ['family', 'private']
+        self.timed(photos, 'search_photos', lambda: db.search_photos('bench', tags), self.repeat)
+        files = [p['file'] for p in db.search_photos('bench', tags)['photos']]
+        if files:
+            self.timed(photos, 'search_photo', lambda: [db._search_photo('bench', f, tags) for f in files], 1)
+            #fill the cache first, the timed calls are all hits
+            for f in files:
+                db.search_photo('bench', f, tags)
+            self.timed(photos, 'search_photo_cached', lambda: [db.search_photo('bench', f, tags) for f in files], self.repeat)
+
+        client = fotos.app.test_client()
+        with client.session_transaction() as session:
+            session['user'] = {'email': 'bench@localhost', 'tags': ['admin'] + tags, 'name': 'bench', 'picture': ''}
+        self.timed(photos, 'route_album', lambda: check(client.get('/bench')), self.repeat)
+        if files:
+            self.timed(photos, 'route_thumb', lambda: [check(client.get('/bench/thumbs/%s' % f)) for f in files], 1)
+        #the next library size gets a new db
+        db.close()
+
+def check(response):
+    if response.status_code != 200:
+        raise Exception("%s %s" % (response.status_code, response.request.path))
+    response.close()
+    return response
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd = benchPath, stderr = subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, previousFile):
+    with open(previousFile) as f:
+        previous = {(r['photos'], r['name']): r for r in json.load(f)['results']}
+    print("\ncompared to %s" % previousFile)
+    for r in results:
+        p = previous.get((r['photos'], r['name']))
+        if p:
+            print("%6d photos  %-24s %6.2fx" % (r['photos'], r['name'], r['per_call_ms'] / p['per_call_ms']))
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-p', '--photos', default='20,100', help='Comma separated library sizes')
+    argparser.add_argument('-s', '--size', default='4000x3000', help='Photo size')
+    argparser.add_argument('-r', '--repeat', type=int, default=20, help='Repetitions of the fast calls')
+    argparser.add_argument('-o', '--output', help='Result json file (default: stdout)')
+    argparser.add_argument('-c', '--compare', help='Previous result json file')
+    argparser.add_argument('-k', '--keep', action="store_true", help='Keep the generated library')
+    args = argparser.parse_args()
+
+    workDir = tempfile.mkdtemp(prefix = 'fotos-bench-')
+    bench = Bench(args.repeat)
+    try:
+        for photos in [int(p) for p in args.photos.split(',')]:
+            bench.run(photos, tuple([int(x) for x in args.size.split('x')]), workDir)
+    finally:
+        if args.keep:
+            print("Library kept in %s" % workDir)
+        else:
+            shutil.rmtree(workDir)
+
+    output = {'version': version(), 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'size': args.size, 'results': bench.results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent = 4)
+    else:
+        print(json.dumps(output, indent = 4))
+    if args.compare:
+        compare(bench.results, args.compare)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+synthetic photo library for the benchmarks: jpegs made with pillow, with rating, caption, tags and date metadata
+"""
+import os, argparse, random, datetime
+import pyexiv2
+from PIL import Image
+
+TAGS = ['family', 'private', 'trip', 'mountain', 'sea', 'ak']
+
+def generate_library(root, name, photos, folders = 3, size = (4000, 3000), seed = 0):
+    """
+    creates root/name with photos jpegs spread over the album folder and nested sub folders
+    returns the paths of the generated photos
+    """
+    rng = random.Random(seed)
+    albumPath = os.path.join(root, name)
+    dirs = [albumPath]
+    for i in range(folders):
+        #every other sub folder is nested in the previous one
+        parent = dirs[-1] if i % 2 else albumPath
+        dirs.append(os.path.join(parent, 'sub%d' % i))
+    for d in dirs:
+        os.makedirs(d, exist_ok = True)
+
+    start = datetime.datetime(2020, 6, 1, 8, 0, 0)
+    files = []
+    for i in range(photos):
+        imgPath = os.path.join(dirs[i % len(dirs)], 'IMG_%05d.jpg' % i)
+        generate_photo(imgPath, size, rng)
+        metadata = pyexiv2.metadata.ImageMetadata(imgPath)
+        metadata.read()
+        metadata['Xmp.xmp.Rating'] = pyexiv2.XmpTag('Xmp.xmp.Rating', rng.choice([0, 1, 1, 2, 3]))
+        metadata['Exif.Image.ImageDescription'] = pyexiv2.ExifTag('Exif.Image.ImageDescription', 'photo %d of %s' % (i, name))
+        metadata['Xmp.dc.subject'] = pyexiv2.XmpTag('Xmp.dc.subject', rng.sample(TAGS, rng.randint(1, 3)))
+        metadata['Exif.Photo.DateTimeOriginal'] = pyexiv2.ExifTag('Exif.Photo.DateTimeOriginal', start + datetime.timedelta(minutes = 7 * i))
+        metadata['Exif.Image.Artist'] = pyexiv2.ExifTag('Exif.Image.Artist', 'fotos benchmark')
+        metadata.write()
+        files.append(imgPath)
+    return files
+
+def generate_photo(imgPath, size, rng):
+    """
+    smooth random content with some grain, compresses like a real photo rather than like noise or a flat color
+    all the pixels come from rng so the same seed gives the same files
+    """
+    w, h = size[0] // 64, size[1] // 64
+    im = Image.frombytes('RGB', (w, h), rng.randbytes(w * h * 3)).resize(size, Image.BICUBIC)
+    tile = Image.frombytes('RGB', (256, 256), rng.randbytes(256 * 256 * 3))
+    grain = Image.new('RGB', size)
+    for x in range(0, size[0], 256):
+        for y in range(0, size[1], 256):
+            grain.paste(tile, (x, y))
+    im = Image.blend(im, grain, 0.1)
+    if rng.random() < 0.2:
+        #portrait
+        im = im.transpose(Image.ROTATE_90)
+    im.save(imgPath, 'JPEG', quality = 90)
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('root', help='Library root folder')
+    argparser.add_argument('-n', '--name', default='bench', help='Album folder name')
+    argparser.add_argument('-p', '--photos', type=int, default=100, help='Number of photos')
+    argparser.add_argument('-s', '--size', default='4000x3000', help='Photo size')
+    argparser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed gives the same library')
+    args = argparser.parse_args()
+    size = tuple([int(x) for x in args.size.split('x')])
+    files = generate_library(args.root, args.name, args.photos, size = size, seed = args.seed)
+    print("Generated %d photos in %s" % (len(files), os.path.join(args.root, args.name)))
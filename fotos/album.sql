@@ -31,4 +31,4 @@ create table photo (
 create table user (
     id TEXT PRIMARY KEY,
     tags TEXT
-);s
\ No newline at end of file
+);
@@ -1,12 +1,88 @@
-import os, shutil, datetime
+import os, shutil, datetime, threading, io, time
 import pyexiv2, datetime, json
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, Future
 from PIL import Image, ImageOps
 
 class AlbumParser:
+    #timed stages of the photo processing, summed as <stage>_seconds in the parse statistics
+    STAGES = ['decode', 'resize', 'encode', 'metadata']
+
     def __init__(self, config, logger) -> None:
         self.config = config
         self.logger = logger
         self.skipDirs = [self.config["albumDir"], self.config["thumbDir"], 'js', 'css', 'default-skin', 'img']
+        #modern formats written next to the jpeg derivatives, limited to what this pillow build can encode
+        Image.init()
+        self.modernFormats = [fmt for fmt in self.config.get("modernFormats", []) if fmt in Image.SAVE]
+        #settings the thumbs and ladder images were made with, kept in the manifest to redo them when changed
+        #the album copy is never redone, it holds the rating edits
+        self.derivativeSettings = json.dumps({'thumbSizeSmall': self.config["thumbSizeSmall"], 'thumbSizeLarge': self.config["thumbSizeLarge"],
+            'ratingLargeThumb': self.config["ratingLargeThumb"], 'widthLadder': self.config.get("widthLadder", []), 'modernFormats': self.modernFormats}, sort_keys = True)
+        #optional callable(processed) called after each photo
+        self.progress = None
+        self.processed = 0
+        self._progressLock = threading.Lock()
+        #parse statistics, summed from the per photo statistics returned by parse_photo
+        self.stats = Counter()
+        self.photoStats = Counter()
+        #lazy mode: parse only records sizes, derivatives are created by ensure_derivative on their first request
+        self.lazy = self.config.get("lazyDerivatives", False)
+        #derivative path -> [lock, users], one resize per derivative however many requests wait for it
+        self._fileLocks = {}
+        self._fileLocksLock = threading.Lock()
+
+    def __getstate__(self):
+        """pool workers only get the configuration, not the progress reporting nor the locks of the parent"""
+        state = self.__dict__.copy()
+        state['progress'] = None
+        del state['_progressLock']
+        del state['_fileLocks']
+        del state['_fileLocksLock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._progressLock = threading.Lock()
+        self._fileLocks = {}
+        self._fileLocksLock = threading.Lock()
+
+    def photo_done(self, future = None):
+        with self._progressLock:
+            self.processed += 1
+            processed = self.processed
+        if self.progress:
+            self.progress(processed)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.photoStats[stage + '_seconds'] += time.perf_counter() - start
+
+    def log_stats(self, path):
+        """logs the parse statistics and the stage timings summed over the photos"""
+        timings = [stage + '_seconds' for stage in self.STAGES]
+        self.logger.info("Parse statistics %s: %s" % (path, ', '.join(["%s %s" % (k, v) for k, v in sorted(self.stats.items()) if k not in timings])))
+        decoded = self.stats['decoded']
+        if decoded:
+            self.logger.info("Parse timings %s: %s for %d decoded photos" % (path, ', '.join(["%s %.2f s (%.1f ms/photo)" % 
+                (stage, self.stats[stage + '_seconds'], self.stats[stage + '_seconds'] * 1000 / decoded) for stage in self.STAGES]), decoded))
+
+    def count_photos(self, path, basePath = None):
+        """returns the number of photos below an album path, used as progress total"""
+        for basePath in self.base_paths(basePath):
+            fullPath = os.path.join(basePath, path)
+            if os.path.exists(fullPath):
+                count = 0
+                for root, dirs, files in os.walk(fullPath):
+                    dirs[:] = [d for d in dirs if d not in self.skipDirs]
+                    count += len([f for f in files if f.upper().endswith(tuple(self.config["formats"]))])
+                return count
+        return None
 
     def import_album(self, path):
         """ imports an already created album folder """
@@ -16,27 +92,92 @@ class AlbumParser:
                 fullPath = os.path.join(basePath, path)
 
                 #parsed in a different place, just load in the db
-                albumDataFile = os.path.join(fullPath, self.config["albumDir"], self.config["albumDataFile"])
-                if os.path.exists(albumDataFile) and os.path.isfile(albumDataFile):
-                    self.logger.info("Loading %s" % albumDataFile)
-                    with open(albumDataFile) as json_file:
-                        album = json.load(json_file)
-                        album['base_path'] = basePath
-                        return album
-                else:
-                    raise Exception("Missing %s" % albumDataFile)
+                album = self.load_album_data(fullPath)
+                album['base_path'] = basePath
+                return album
         raise Exception("Cannot find album %s in %s" % (path, ','.join(self.config['paths'])))
 
-    def parse(self, path, deleteExisting):
-        for basePath in self.config["paths"]:
+    def load_album_data(self, fullPath):
+        """loads album.json, sub folders stored by name are loaded from their own album.json"""
+        albumDataFile = os.path.join(fullPath, self.config["albumDir"], self.config["albumDataFile"])
+        if not (os.path.exists(albumDataFile) and os.path.isfile(albumDataFile)):
+            raise Exception("Missing %s" % albumDataFile)
+        self.logger.info("Loading %s" % albumDataFile)
+        with open(albumDataFile) as json_file:
+            album = json.load(json_file)
+        folders = []
+        for folder in album['folders']:
+            if isinstance(folder, str):
+                folder = self.load_album_data(os.path.join(fullPath, folder))
+            folders.append(folder)
+        album['folders'] = folders
+        return album
+
+    def parse(self, path, deleteExisting, jobs = None):
+        """
+        parses an album folder tree and returns it as nested albums, see iter_parse
+        """
+        albums = {}
+        top = None
+        for record in self.iter_parse(path, deleteExisting, jobs):
+            if record[0] == 'album':
+                album = dict(record[1], photos = [], folders = [])
+                parent = album.pop('parent')
+                if parent:
+                    albums[parent]['folders'].append(album)
+                else:
+                    top = album
+                albums[album['name']] = album
+            elif record[0] == 'photo':
+                albums[record[1]]['photos'].append(record[2])
+        return top
+
+    def iter_parse(self, path, deleteExisting, jobs = None, basePath = None):
+        """
+        parses an album folder tree, yielding records as they are parsed:
+        ('album', album) when a folder starts, album has no photos and its parent name
+        ('photo', album_name, photo) for each photo, ('end', album_name) when a folder is done
+        only the photos of the folders being parsed are kept in memory
+
+        :param int jobs: number of worker processes for photo parsing, defaults to config parseJobs, 0 means one per cpu
+        :param str basePath: the library root of path, by default the first of config paths containing path
+        """
+        jobs = self.parse_jobs(jobs)
+        self.processed = 0
+        self.stats = Counter()
+        for basePath in self.base_paths(basePath):
             testPath = os.path.join(basePath, path)
             if os.path.exists(testPath):
                 #find only the first matching path
-                return self.parse_album_folder(basePath, path, deleteExisting)
+                if jobs > 1:
+                    self.logger.info("Parsing %s with %d jobs" % (path, jobs))
+                    with ProcessPoolExecutor(max_workers = jobs) as pool:
+                        yield from self.parse_album_folder(basePath, path, deleteExisting, pool = pool)
+                else:
+                    yield from self.parse_album_folder(basePath, path, deleteExisting)
+                self.log_stats(path)
+                return
         raise Exception("Cannot find album %s in %s" % (path, ','.join(self.config['paths'])))
 
-    def parse_album_folder(self, basePath, path, deleteExisting, parent = None):
-        """ parses an album folder which might contain sub folders """
+    def base_paths(self, basePath):
+        """the library roots where an album path is looked for"""
+        return [basePath] if basePath else self.config["paths"]
+
+    def parse_jobs(self, jobs):
+        """number of worker processes, defaults to config parseJobs, 0 means one per cpu"""
+        if jobs is None:
+            jobs = self.config.get("parseJobs", 1)
+        if jobs < 1:
+            jobs = os.cpu_count() or 1
+        return jobs
+
+    def parse_album_folder(self, basePath, path, deleteExisting, parent = None, pool = None):
+        """ parses an album folder which might contain sub folders, yields the records described in iter_parse
+
+        album.json lists the sub folders by name, each one has its own album.json
+
+        :param pool: optional executor, photos are submitted to it and yielded in listing order after the sub folders
+        """
         fullPath = os.path.join(basePath, path)
 
         #load album tags from file
@@ -49,8 +190,10 @@ class AlbumParser:
                 album = json.load(json_file)
 
         tags = None
+        previous = {}
         if album:
             tags = album['tags']
+            previous = {p['file']: self.repair_photo(p) for p in album.get('photos', [])}
 
         album_name = os.path.basename(fullPath)
         if parent:
@@ -64,6 +207,7 @@ class AlbumParser:
             "folders": [],
             "tags": tags or []
         }
+        yield ('album', {"name": album_name, "base_path": basePath, "path": path, "tags": album["tags"], "parent": parent})
 
         albumFolder = os.path.join(fullPath, self.config["albumDir"])
         hasAlbum = os.path.exists(albumFolder) #check if there is an album folder already
@@ -74,34 +218,266 @@ class AlbumParser:
 
         if not os.path.exists(albumFolder):
             os.makedirs(albumFolder)
+        manifest = self.load_manifest(albumFolder) if thisIsAFotosAlbum and hasAlbum else {}
+        newManifest = {}
+        unchanged = 0
         for f in os.listdir(fullPath):
             filePath = os.path.join(fullPath, f)
             if os.path.isdir(filePath) and f not in self.skipDirs:
-                #handle subfolders
-                album['folders'].append(self.parse_album_folder(basePath, os.path.join(path, f), deleteExisting, album_name))
+                #handle subfolders, after the photos of this folder
+                album['folders'].append(f)
             else:
                 #handle photos
                 refFile = f.upper()
                 if refFile.endswith(tuple(self.config["formats"])):
-                    image = self.parse_image(fullPath, f, hasAlbum)
+                    image = previous.get(f)
+                    #manifests written before the settings were recorded are taken as made with the current ones
+                    redo = manifest.get(f, {}).get('settings', self.derivativeSettings) != self.derivativeSettings
+                    if image and not redo and self.is_unchanged(fullPath, f, manifest.get(f)):
+                        newManifest[f] = dict(manifest[f], settings = self.derivativeSettings)
+                        unchanged += 1
+                        self.photo_done()
+                    elif pool:
+                        image = pool.submit(self.parse_photo, fullPath, f, hasAlbum, redo)
+                        image.add_done_callback(self.photo_done)
+                    else:
+                        image = self.collect(self.parse_photo(fullPath, f, hasAlbum, redo))
+                        self.photo_done()
                     album['photos'].append(image)
+                    if not pool:
+                        yield ('photo', album_name, image)
+
+        for f in album['folders']:
+            yield from self.parse_album_folder(basePath, os.path.join(path, f), deleteExisting, album_name, pool)
+
+        if pool:
+            #wait for the photos of this folder, keeps the listing order
+            album['photos'] = [self.collect(image.result()) if isinstance(image, Future) else image for image in album['photos']]
+            for image in album['photos']:
+                yield ('photo', album_name, image)
+
+        for image in album['photos']:
+            if image['file'] not in newManifest:
+                newManifest[image['file']] = self.manifest_entry(fullPath, image)
+        self.logger.info("Parsed %s: %d photos, %d unchanged" % (path, len(album['photos']), unchanged))
+
+        #remove photos deleted from the source
+        for f in manifest:
+            if f not in newManifest:
+                self.remove_derivatives(fullPath, f)
 
         #save parsed album to a file
         with open(albumDataFile, 'w') as outfile:
             json.dump(album, outfile, indent=4, default=str)
+        self.save_manifest(albumFolder, newManifest)
 
-        return album
+        yield ('end', album_name)
 
-    def parse_image(self, root, file, hasAlbum):
+    def repair_photo(self, image):
         """
-        :param bool hasAlbum: there is an album folder already, don't regenerate photos
+        a photo from album.json, older imports changed the photos before they were saved: tags and widths comma joined
+        and the db album_id added
         """
-        imgPath = os.path.join(root, file)
-        imgPathRelForSymlink = os.path.join("..", file) 
+        image.pop('album_id', None)
+        if isinstance(image.get('tags'), str):
+            image['tags'] = [tag for tag in image['tags'].split(',') if tag]
+        if isinstance(image.get('widths'), str):
+            image['widths'] = [int(w) for w in image['widths'].split(',') if w]
+        return image
+
+    def derivative_paths(self, root, file):
+        """returns the album image and thumbnail paths of a source photo"""
         albumImgPath = os.path.join(root, self.config["albumDir"], file)
         albumImgPath = albumImgPath.replace(".JPG", ".jpg")
         thumbImgPath = os.path.join(root, self.config["albumDir"], self.config["thumbDir"], file)
         thumbImgPath = thumbImgPath.replace(".JPG", ".jpg")
+        return albumImgPath, thumbImgPath
+
+    def ladder_path(self, root, file, width):
+        """returns the path of the width wide album image of a source photo"""
+        ladderImgPath = os.path.join(root, self.config["albumDir"], "w%d" % width, file)
+        return ladderImgPath.replace(".JPG", ".jpg")
+
+    def load_manifest(self, albumFolder):
+        """returns the per photo manifest written by the previous parse, {} if missing"""
+        manifestFile = os.path.join(albumFolder, self.config.get("albumManifestFile", "manifest.json"))
+        if os.path.isfile(manifestFile):
+            with open(manifestFile) as json_file:
+                return json.load(json_file)
+        return {}
+
+    def save_manifest(self, albumFolder, manifest):
+        manifestFile = os.path.join(albumFolder, self.config.get("albumManifestFile", "manifest.json"))
+        with open(manifestFile, 'w') as outfile:
+            json.dump(manifest, outfile)
+
+    def manifest_entry(self, root, image):
+        """
+        state of a photo after parsing: size and mtime of the source and of the album copy (where ratings are edited),
+        if it has a thumb and the settings of its derivatives
+        """
+        file = image['file']
+        st = os.stat(os.path.join(root, file))
+        albumImgPath, thumbImgPath = self.derivative_paths(root, file)
+        albumMtime = os.lstat(albumImgPath).st_mtime if os.path.lexists(albumImgPath) else None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'album_mtime': albumMtime, 'thumb': bool(image['thumb_height']), 
+            'settings': self.derivativeSettings}
+
+    def is_unchanged(self, root, file, entry):
+        """
+        :param dict entry: the photo from the previous manifest
+        """
+        if not entry:
+            return False
+        st = os.stat(os.path.join(root, file))
+        if st.st_size != entry['size'] or st.st_mtime != entry['mtime']:
+            return False
+        albumImgPath, thumbImgPath = self.derivative_paths(root, file)
+        albumMtime = os.lstat(albumImgPath).st_mtime if os.path.lexists(albumImgPath) else None
+        if entry['album_mtime'] is not None and albumMtime != entry['album_mtime']:
+            #rating changed in the album copy, an album copy created since (lazy mode) is not an edit
+            return False
+        if entry['thumb'] and not self.lazy and not os.path.exists(thumbImgPath):
+            return False
+        return True
+
+    def remove_derivatives(self, root, file):
+        """removes the album image and thumbnail of a photo deleted from the source"""
+        self.logger.info("Removing deleted photo %s" % file)
+        derivatives = list(self.derivative_paths(root, file)) + [self.ladder_path(root, file, w) for w in self.config.get("widthLadder", [])]
+        for derivative in derivatives:
+            self.remove_file(derivative)
+
+    def remove_file(self, derivative):
+        """removes a derivative and its modern format variants"""
+        for variant in [derivative] + ['%s.%s' % (derivative, fmt.lower()) for fmt in self.config.get("modernFormats", [])]:
+            if os.path.lexists(variant):
+                os.remove(variant)
+
+    def is_outdated_thumb(self, imgPath, thumbImgPath, thumbSize):
+        """lazy mode: a created thumb is outdated if older than its source or of another size class than thumbSize"""
+        if not os.path.exists(thumbImgPath):
+            return False
+        if os.path.getmtime(thumbImgPath) < os.path.getmtime(imgPath):
+            return True
+        with Image.open(thumbImgPath) as im:
+            #only reads the header
+            return im.size[1] != thumbSize
+
+    @contextmanager
+    def file_lock(self, path):
+        """per path lock of this process, dropped once nobody waits for it"""
+        with self._fileLocksLock:
+            entry = self._fileLocks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._fileLocksLock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._fileLocks[path]
+
+    def ensure_derivative(self, root, file, thumb = False, width = None):
+        """
+        lazy mode: creates the album image, the thumb or a width ladder image of a selected photo if missing,
+        returns True if it was created
+        concurrent requests for the same derivative wait for the first one instead of resizing it again,
+        files are written under a temporary name and renamed so other processes never serve a partial file
+        """
+        albumImgPath, thumbImgPath = self.derivative_paths(root, file)
+        if thumb:
+            path = thumbImgPath
+        elif width:
+            path = self.ladder_path(root, file, width)
+        else:
+            path = albumImgPath
+        with self.file_lock(path):
+            if os.path.lexists(path):
+                return False
+            start = time.perf_counter()
+            imgPath = os.path.join(root, file)
+            #ratings are edited in the album copy once it exists
+            metadata = pyexiv2.metadata.ImageMetadata(albumImgPath if os.path.exists(albumImgPath) else imgPath)
+            metadata.read()
+            rating = self.get_exif_tag(metadata, self.config["exif"]["ratingKeys"])
+            rating = rating.value if rating else 0
+            favorite = self.get_exif_tag(metadata, self.config["exif"]["favoriteKeys"])
+            if rating < 1 and not (favorite and favorite.value == '1'):
+                raise Exception("Photo %s is not selected" % imgPath)
+            self.clean_exif(metadata)
+
+            size = self.config["imageSize"]
+            if thumb:
+                size = self.config["thumbSizeLarge"] if rating >= self.config["ratingLargeThumb"] else self.config["thumbSizeSmall"]
+            elif width:
+                size = width
+            with Image.open(imgPath) as im:
+                imgSize = im.size
+            if not thumb and not width and imgSize[0] < size and imgSize[1] < size:
+                #image is small, no resize needed, relative symlink as in parse_image
+                os.symlink(os.path.join("..", file), path)
+            else:
+                im = self.decode_image(imgPath, size)
+                try:
+                    self.scale_image(im, path, size, metadata, fitWidth = width is not None)
+                finally:
+                    im.close()
+            self.logger.info("Created %s in %.0f ms" % (path, (time.perf_counter() - start) * 1000))
+            return True
+
+    def warm(self, path, jobs = None):
+        """
+        lazy mode: creates the missing derivatives of the selected photos of a parsed album tree ahead of the first
+        visitors, for albums known to be popular, returns the number created
+        """
+        jobs = self.parse_jobs(jobs)
+        for basePath in self.config["paths"]:
+            fullPath = os.path.join(basePath, path)
+            if os.path.exists(fullPath):
+                tasks = []
+                for root, dirs, files in os.walk(fullPath):
+                    dirs[:] = [d for d in dirs if d not in self.skipDirs]
+                    albumDataFile = os.path.join(root, self.config["albumDir"], self.config["albumDataFile"])
+                    if os.path.isfile(albumDataFile):
+                        with open(albumDataFile) as json_file:
+                            album = json.load(json_file)
+                        for image in [self.repair_photo(p) for p in album['photos']]:
+                            if image['thumb_height']:
+                                #thumbs first, they are requested first
+                                tasks.append((root, image['file'], True, None))
+                                tasks.extend([(root, image['file'], False, w) for w in image.get('widths') or []])
+                                tasks.append((root, image['file'], False, None))
+                if jobs > 1:
+                    with ProcessPoolExecutor(max_workers = jobs) as pool:
+                        created = sum(pool.map(self.ensure_derivative, *zip(*tasks))) if tasks else 0
+                else:
+                    created = sum([self.ensure_derivative(*task) for task in tasks])
+                self.logger.info("Warmed %s: %d derivatives created, %d present" % (path, created, len(tasks) - created))
+                return created
+        raise Exception("Cannot find album %s in %s" % (path, ','.join(self.config['paths'])))
+
+    def parse_photo(self, root, file, hasAlbum, redo = False):
+        """parse_image returning also the statistics of the photo, pool workers can not update the parent statistics"""
+        self.photoStats = Counter()
+        image = self.parse_image(root, file, hasAlbum, redo)
+        return image, self.photoStats
+
+    def collect(self, result):
+        """adds the statistics returned by parse_photo to the parse statistics, returns the photo"""
+        image, stats = result
+        self.stats.update(stats)
+        return image
+
+    def parse_image(self, root, file, hasAlbum, redo = False):
+        """
+        :param bool hasAlbum: there is an album folder already, don't regenerate photos
+        :param bool redo: the derivative settings changed, the ladder images are made again (the thumb always is)
+        """
+        imgPath = os.path.join(root, file)
+        imgPathRelForSymlink = os.path.join("..", file) 
+        albumImgPath, thumbImgPath = self.derivative_paths(root, file)
 
         #self.logger.info('Processing %s to %s and %s' % (imgPath, albumImgPath, thumbImgPath))
 
@@ -109,7 +485,8 @@ class AlbumParser:
             metadata = pyexiv2.metadata.ImageMetadata(albumImgPath)
         else:
             metadata = pyexiv2.metadata.ImageMetadata(imgPath)
-        metadata.read()
+        with self.timer('metadata'):
+            metadata.read()
         
         caption = self.get_exif_tag(metadata, self.config["exif"]["captionKeys"])
         if caption:
@@ -137,16 +514,25 @@ class AlbumParser:
         rating = self.get_exif_tag(metadata, self.config["exif"]["ratingKeys"])
         if os.path.exists(albumImgPath):
             #the album was already generated, update rating for selected album photos to at least 1
+            #all the changes of the album copy are collected and written once
+            changed = False
             if rating:
                 rating_value = rating.value
                 if rating_value == 0:
                     rating.value = 1
-                    metadata.write()
+                    changed = True
             else:
                 tag_name = self.config["exif"]["ratingKeys"][0]
                 metadata[tag_name] = pyexiv2.XmpTag(tag_name, 1)
-                metadata.write()
-            self.sync_back_metadata(metadata, imgPath)
+                changed = True
+            previousWrites = 3 if changed else 2
+            if os.path.realpath(albumImgPath) != os.path.realpath(imgPath):
+                #not a symlink to the original
+                changed = self.sync_back_metadata(metadata, imgPath) or changed
+            if changed:
+                self.write_metadata(metadata, albumImgPath)
+            #the rating fix and the sync back used to write the album copy twice and the original once, whatever changed
+            self.photoStats['metadata_writes_saved'] += previousWrites - self.photoStats['metadata_writes']
 
         rating = self.get_exif_tag(metadata, self.config["exif"]["ratingKeys"])
         if rating:
@@ -157,39 +543,79 @@ class AlbumParser:
         #self.logger.info(f"Rating {file} -> {rating}")
 
         thumbSize = (0, 0)
-        im = Image.open(imgPath)
-        imgSize = im.size
-        im.close()
+        widths = []
+        with Image.open(imgPath) as im:
+            #only reads the header
+            imgSize = im.size
+            orientedSize = imgSize
+            if im.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+                #rotated by 90 degrees once transposed
+                orientedSize = (imgSize[1], imgSize[0])
 
         if rating >= 1 or favorite:
+            if rating >= self.config["ratingLargeThumb"]:
+                thumbSize = self.config["thumbSizeLarge"]
+            else:
+                thumbSize = self.config["thumbSizeSmall"]
+
+            #responsive ladder, only widths smaller than the album image
+            size = self.config["imageSize"]
+            albumWidth = orientedSize[0]
+            if imgSize[0] >= size or imgSize[1] >= size:
+                albumWidth = int(orientedSize[0] * size / orientedSize[1])
+            widths = [w for w in self.config.get("widthLadder", []) if w < albumWidth]
+
+            if self.lazy:
+                #sizes the derivatives will have, the thumb is removed only if outdated
+                if redo or self.is_outdated_thumb(imgPath, thumbImgPath, thumbSize):
+                    self.remove_file(thumbImgPath)
+                if redo:
+                    for w in self.config.get("widthLadder", []):
+                        self.remove_file(self.ladder_path(root, file, w))
+                if not os.path.exists(albumImgPath) and (imgSize[0] >= size or imgSize[1] >= size):
+                    imgSize = (albumWidth, size)
+                thumbSize = (int(orientedSize[0] * thumbSize / orientedSize[1]), thumbSize)
+                return {'date_time': dateTime, 'file': file, 'caption': caption, 
+                    'width': imgSize[0], 'height': imgSize[1], 
+                    'thumb_width': thumbSize[0], 'thumb_height': thumbSize[1],
+                    'thumbDir': self.config["thumbDir"], 'tags': tags, 'rating': rating, 'favorite': favorite, 'widths': widths}
+
             self.logger.info("Ensure photo and thumb for %s" % file)
             #generate the album if not already generated and if image is selected
 
             #clean metadata
-            self.clean_exif(metadata)
+            with self.timer('metadata'):
+                self.clean_exif(metadata)
 
-            #create thumbnail
-            if rating >= self.config["ratingLargeThumb"]:
-                size = self.config["thumbSizeLarge"]
-            else:
-                size = self.config["thumbSizeSmall"]
-            thumbSize = self.scale_image(imgPath, thumbImgPath, size, metadata)
+            createWidths = [w for w in widths if redo or not os.path.exists(self.ladder_path(root, file, w))]
+
+            #decode the original once, large enough for the biggest derivative
+            createAlbumImg = not os.path.exists(albumImgPath)
+            scaleAlbumImg = createAlbumImg and (imgSize[0] >= size or imgSize[1] >= size)
+            im = self.decode_image(imgPath, max([size if scaleAlbumImg else 0, thumbSize] + createWidths))
 
             #create album image
-            if not os.path.exists(albumImgPath):
-                size = self.config["imageSize"]
-                if imgSize[0] >= size or imgSize[1] >= size:
-                    imgSize = self.scale_image(imgPath, albumImgPath, size, metadata)
+            if createAlbumImg:
+                if scaleAlbumImg:
+                    im = self.scale_image(im, albumImgPath, size, metadata)
+                    imgSize = im.size
                 else:
                     #image is small, no resize needed, create symlink
                     if(os.path.exists(albumImgPath)):
                         os.remove(albumImgPath)
                     os.symlink(imgPathRelForSymlink, albumImgPath) #symlink must be relative otherwise will get destroyed by rsync   
 
+            for w in createWidths:
+                #ladder images are newer than the metadata rewrite, they saved nothing
+                self.scale_image(im, self.ladder_path(root, file, w), w, metadata, fitWidth = True, countSaved = False)
+
+            #create thumbnail from the in memory image
+            thumbSize = self.scale_image(im, thumbImgPath, thumbSize, metadata).size
+
         return {'date_time': dateTime, 'file': file, 'caption': caption, 
             'width': imgSize[0], 'height': imgSize[1], 
             'thumb_width': thumbSize[0], 'thumb_height': thumbSize[1],
-            'thumbDir': self.config["thumbDir"], 'tags': tags, 'rating': rating, 'favorite': favorite}
+            'thumbDir': self.config["thumbDir"], 'tags': tags, 'rating': rating, 'favorite': favorite, 'widths': widths}
 
     def get_exif_tag(self, metadata, keys):
         """return first tag from keys or none if nothing found"""
@@ -211,18 +637,27 @@ class AlbumParser:
     def sync_back_metadata(self, metadata, imgPath):
         """When importing from an existing album, sync some metadata back to the original file
 
+        The original is only written if its rating or subject tags differ, the album metadata is not written
+
         Args:
             metadata: from the album file
             imgPath: the original file
+
+        Returns:
+            True if the album metadata was changed by merging the original subject tags
         """
         orig_metadata = pyexiv2.metadata.ImageMetadata(imgPath)
-        orig_metadata.read()
+        with self.timer('metadata'):
+            orig_metadata.read()
+        orig_changed = False
+        changed = False
         for k in self.config['exif']['ratingKeys']:
             m = self.get_exif_tag(metadata, [k])
             om = self.get_exif_tag(orig_metadata, [k])
-            if m:
+            if m and (not om or om.value != m.value):
                 new_tag = pyexiv2.XmpTag(k, m.value)
                 orig_metadata[k] = new_tag
+                orig_changed = True
 
         #merge subject tags
         for k in ['Xmp.dc.subject']:
@@ -237,31 +672,85 @@ class AlbumParser:
                     if t not in tags:
                         tags.append(t)
             if len(tags) > 0:
-                metadata[k] = pyexiv2.XmpTag(k, tags)
-                orig_metadata[k] = pyexiv2.XmpTag(k, tags)
-
-        orig_metadata.write()
-        metadata.write()
+                if not m or m.value != tags:
+                    metadata[k] = pyexiv2.XmpTag(k, tags)
+                    changed = True
+                if not om or om.value != tags:
+                    orig_metadata[k] = pyexiv2.XmpTag(k, tags)
+                    orig_changed = True
+
+        if orig_changed:
+            self.write_metadata(orig_metadata, imgPath)
+        return changed
+
+    def write_metadata(self, metadata, imgPath):
+        """writes metadata back to its file, which rewrites the whole jpeg"""
+        with self.timer('metadata'):
+            metadata.write()
+        self.photoStats['metadata_writes'] += 1
+        self.photoStats['metadata_bytes_written'] += os.path.getsize(imgPath)
+
+    def decode_image(self, imgPath, size):
+        """
+        decodes a photo once and applies the exif orientation, jpegs are decoded in draft mode at the smallest
+        power of two reduction still covering size x size, which is much faster than a full decode
+        """
+        with self.timer('decode'):
+            im = Image.open(imgPath)
+            if im.format == "JPEG":
+                im.draft("RGB", (size, size))
+            #decoded here rather than lazily by the first resize, so the decode is timed on its own
+            im.load()
+            #either this or keep orientation in exif "Exif.Image.Orientation"
+            transposed = ImageOps.exif_transpose(im)
+            if transposed is not im:
+                im.close()
+        self.photoStats['decoded'] += 1
+        return transposed
+
+    def scale_image(self, im, scaledImgPath, size, metadata, fitWidth = False, countSaved = True):
+        """
+        saves im scaled to size height (size width if fitWidth) and returns the scaled image
 
-    def scale_image(self, imgPath, scaledImgPath, size, metadata):
+        :param bool countSaved: the metadata used to be written to this file after saving it, count the write saved
+        """
         dirName = os.path.dirname(scaledImgPath)
         if not os.path.exists(dirName):
             os.makedirs(dirName)
 
-        im = Image.open(imgPath)
-        #either this or keep orientation in exif "Exif.Image.Orientation"
-        im = ImageOps.exif_transpose(im)
-
-        newSize = [int(im.width * size / im.height), size]
+        if fitWidth:
+            newSize = [size, int(im.height * size / im.width)]
+        else:
+            newSize = [int(im.width * size / im.height), size]
 
         #im.thumbnail(size, Image.ANTIALIAS)
-        im = im.resize(newSize, Image.LANCZOS)
-        im.save(scaledImgPath, "JPEG")
-        
+        with self.timer('resize'):
+            im = im.resize(newSize, Image.LANCZOS)
+        with self.timer('encode'):
+            encoded = io.BytesIO()
+            im.save(encoded, "JPEG")
+            data = encoded.getvalue()
         if metadata:
-            newMetadata = pyexiv2.metadata.ImageMetadata(scaledImgPath)
-            newMetadata.read()
-            metadata.copy(newMetadata)
-            newMetadata.write()
-
-        return im.size
\ No newline at end of file
+            #embed the cleaned metadata in memory, the file is written once
+            with self.timer('metadata'):
+                newMetadata = pyexiv2.metadata.ImageMetadata.from_buffer(data)
+                newMetadata.read()
+                metadata.copy(newMetadata)
+                newMetadata.write()
+                data = newMetadata.buffer
+            if countSaved:
+                self.photoStats['metadata_writes_saved'] += 1
+                self.photoStats['metadata_bytes_saved'] += len(data)
+        with self.timer('encode'):
+            #written under a temporary name and renamed, the variants before the jpeg which is checked for existence
+            tmpSuffix = '.%d.tmp' % os.getpid()
+            for fmt in self.modernFormats:
+                #<file>.webp, <file>.avif served instead of the jpeg to browsers accepting them
+                variant = '%s.%s' % (scaledImgPath, fmt.lower())
+                im.save(variant + tmpSuffix, fmt)
+                os.replace(variant + tmpSuffix, variant)
+            with open(scaledImgPath + tmpSuffix, 'wb') as outfile:
+                outfile.write(data)
+            os.replace(scaledImgPath + tmpSuffix, scaledImgPath)
+
+        return im
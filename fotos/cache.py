@@ -0,0 +1,42 @@
+import threading
+from collections import OrderedDict
+
+class LruCache:
+    """
+    bounded, thread safe least recently used cache, cleared when the db generation changes
+    """
+    def __init__(self, size) -> None:
+        self.size = size
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation, default = None):
+        with self._lock:
+            if generation != self.generation:
+                #something was imported since the values were cached
+                self._items.clear()
+                self.generation = generation
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last = False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses, 
+                'hit_rate': self.hits / lookups if lookups else 0.0}
@@ -1,61 +1,267 @@
-import sqlite3, os
+import sqlite3, os, threading, time, json, itertools
+from cache import LruCache
+import layout
 
 class Db:
     def __init__(self, config, logger) -> None:
         self.config = config
         self.logger = logger
         self.db_file = self.config["dbFile"] #"album.db"
+        self._local = threading.local()
+        self.photo_cache = LruCache(self.config.get('photoCacheSize', 10000))
+        scriptPath = os.path.dirname(os.path.realpath(__file__))
         if not os.path.exists(self.db_file):
-            self._conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES)
+            conn = self._connection()
 
-            sqlInitFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), "album.sql")
+            sqlInitFile = os.path.join(scriptPath, "album.sql")
             with open(sqlInitFile) as f:
-                self._conn.executescript(f.read())
-            self._conn.close()
+                conn.executescript(f.read())
+        self._migrate(os.path.join(scriptPath, "migrations"))
+
+    def _migrate(self, migrationsDir):
+        """
+        upgrades the schema in place, migrations/<version>-<name>.sql are applied in order on top of album.sql
+        and the applied version is kept in pragma user_version
+        all pending migrations run in one immediate transaction so processes starting at the same time wait for each other
+        """
+        conn = self._connection()
+        migrations = []
+        for f in os.listdir(migrationsDir):
+            if f.endswith(".sql"):
+                migrations.append((int(f.split("-")[0]), f))
+        if conn.execute("pragma user_version").fetchone()[0] >= max([v for v, f in migrations], default = 0):
+            return
+        with conn:
+            conn.execute("begin immediate")
+            #read again under the write lock, another process may have migrated meanwhile
+            version = conn.execute("pragma user_version").fetchone()[0]
+            for migrationVersion, f in sorted(migrations):
+                if migrationVersion > version:
+                    self.logger.info("Migrating %s to version %d: %s" % (self.db_file, migrationVersion, f))
+                    with open(os.path.join(migrationsDir, f)) as sql:
+                        for statement in self._statements(sql.read()):
+                            conn.execute(statement)
+                    conn.execute("pragma user_version = %d" % migrationVersion)
+
+    def _statements(self, script):
+        """splits a sql script in statements, trigger bodies included"""
+        statement = ''
+        for line in script.splitlines(True):
+            statement = statement + line
+            if sqlite3.complete_statement(statement):
+                if statement.strip():
+                    yield statement
+                statement = ''
+
+    def _connection(self):
+        """
+        returns the long lived connection of the current thread, opened on first use
+        connections are not shared between threads nor inherited by forked processes
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256)
+            #wal lets readers run while an import is writing
+            conn.execute("pragma journal_mode = wal")
+            conn.execute("pragma synchronous = normal")
+            conn.execute("pragma busy_timeout = 5000")
+            conn.execute("pragma temp_store = memory")
+            conn.execute("pragma cache_size = -16000")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def close(self):
+        """closes the connection of the current thread"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
 
     def create_album(self, album, parent_id = None):
+        """
+        imports an album tree in a single transaction, albums and photos are upserted by name and (album, file)
+        so ids stay stable and unchanged rows are not rewritten
+        """
+        conn = self._connection()
+        cursor = conn.cursor()
         try:
-            conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES)
-            cursor = conn.cursor()
-            return self._create_album(cursor, album, parent_id)
+            with conn:
+                album_id = self._create_album(cursor, album, parent_id)
+                #delete rogue photos, once per import
+                cursor.execute("delete from photo where album_id not in (select id from album)")
+                self._refresh_virtual_albums(cursor, album_id)
+                cursor.execute("update generation set value = value + 1 where id = 1")
+                return album_id
         finally:
+            cursor.close()
+
+    def import_records(self, records, batch_size = 500):
+        """
+        imports the records streamed by AlbumParser.iter_parse as they come, photos are written every batch_size photos
+        and at the end of each album, each write is committed so an interrupted parse keeps what was imported
+        returns the name of the top album
+        """
+        conn = self._connection()
+        cursor = conn.cursor()
+        #albums being parsed: name -> id, files and sub folders seen
+        parsing = {}
+        batch = []
+        top = None
+        top_id = None
+        try:
+            for record in records:
+                if record[0] == 'album':
+                    album = dict(record[1])
+                    parent = parsing.get(album.pop('parent'))
+                    album_id = self._upsert_album(cursor, album, parent['id'] if parent else None)
+                    if parent:
+                        parent['folders'].append(album['name'])
+                    else:
+                        top = album['name']
+                        top_id = album_id
+                    parsing[album['name']] = {'id': album_id, 'files': set(), 'folders': []}
+                    conn.commit()
+                elif record[0] == 'photo':
+                    parsing[record[1]]['files'].add(record[2]['file'])
+                    batch.append((record[1], record[2]))
+                    if len(batch) >= batch_size:
+                        self._flush_photos(cursor, parsing, batch)
+                        conn.commit()
+                elif record[0] == 'end':
+                    self._flush_photos(cursor, parsing, batch)
+                    album = parsing.pop(record[1])
+                    self._delete_missing(cursor, album['id'], album['files'], album['folders'])
+                    self._layout_album(cursor, album['id'])
+                    cursor.execute("update generation set value = value + 1 where id = 1")
+                    conn.commit()
+            cursor.execute("delete from photo where album_id not in (select id from album)")
+            if top_id is not None:
+                self._refresh_virtual_albums(cursor, top_id)
+            cursor.execute("update generation set value = value + 1 where id = 1")
             conn.commit()
+            return top
+        except:
+            conn.rollback()
+            raise
+        finally:
             cursor.close()
-            conn.close()
 
-    def _create_album(self, cursor, album, parent_id):
-        self.logger.info(f"Importing {album['name']} {album['base_path']}/{album['path']}")
-        cursor.execute("delete from album where name = :name and path = :path and base_path = :base_path", album)
+    def _flush_photos(self, cursor, parsing, batch):
+        albums = {}
+        for album_name, photo in batch:
+            albums.setdefault(album_name, []).append(photo)
+        for album_name, photos in albums.items():
+            self._upsert_photos(cursor, parsing[album_name]['id'], photos)
+        batch.clear()
 
-        #delete rogue photos
-        cursor.execute("delete from photo where album_id not in (select id from album)")
+    def _create_album(self, cursor, album, parent_id):
+        album_id = self._upsert_album(cursor, album, parent_id)
+        self._upsert_photos(cursor, album_id, album['photos'])
         
-        album['tags'] = ','.join(album['tags'])
-        album['parent_id'] = parent_id
+        folder_names = []
+        for folder in album['folders']:
+            self._create_album(cursor, dict(folder, base_path = album['base_path']), album_id)
+            folder_names.append(folder['name'])
+
+        self._delete_missing(cursor, album_id, [photo['file'] for photo in album['photos']], folder_names)
+        self._layout_album(cursor, album_id)
+        return album_id
+
+    def _upsert_album(self, cursor, album, parent_id):
+        """upserts an album, the album dict is left as is, it may still be saved by the parser"""
+        self.logger.info(f"Importing {album['name']} {album['base_path']}/{album['path']}")
         
-        cursor.execute("insert into album(name, path, base_path, tags, parent_id) values (:name, :path, :base_path, :tags, :parent_id)", album)
-        album_id = cursor.lastrowid
-        for photo in album['photos']:
-            photo['album_id'] = album_id
-            photo['tags'] = ','.join(photo['tags'] or [])
-            cursor.execute("insert into photo(album_id, file, width, height, thumb_width, thumb_height, caption, tags, rating, favorite, date_time) values "
-            + "(:album_id, :file, :width, :height, :thumb_width, :thumb_height, :caption, :tags, :rating, :favorite, :date_time)", photo)
+        album_tags = self._tag_list(album['tags'])
+        album = {'name': album['name'], 'path': album['path'], 'base_path': album['base_path'], 'tags': ','.join(album_tags), 'parent_id': parent_id}
         
-        for folder in album['folders']:
-            folder['base_path'] = album['base_path']
-            self._create_album(cursor, folder, album_id)
+        cursor.execute("insert into album(name, path, base_path, tags, parent_id) values (:name, :path, :base_path, :tags, :parent_id) "
+            + "on conflict(name) do update set path = excluded.path, base_path = excluded.base_path, tags = excluded.tags, parent_id = excluded.parent_id "
+            + "where (album.path, album.base_path, album.tags, album.parent_id) is not (excluded.path, excluded.base_path, excluded.tags, excluded.parent_id)", album)
+        cursor.execute("select id from album where name = :name", album)
+        album_id = cursor.fetchone()[0]
+        cursor.execute("delete from album_tag where album_id = ?", (album_id,))
+        cursor.executemany("insert or ignore into album_tag(album_id, tag) values (?, ?)", [(album_id, tag) for tag in self._tag_keys(album_tags)])
         return album_id
 
+    def _upsert_photos(self, cursor, album_id, photos, chunk_size = 500):
+        """
+        upserts photos of an album, tags are rewritten only for new photos and photos whose tags changed
+        the photo dicts are left as is, the parser still saves them in album.json
+        """
+        for i in range(0, len(photos), chunk_size):
+            chunk = photos[i:i + chunk_size]
+            cursor.execute("select file, tags from photo where album_id = ? and file in (%s)" % ','.join(['?'] * len(chunk)), 
+                [album_id] + [photo['file'] for photo in chunk])
+            existing = dict(cursor.fetchall())
+            photo_tags = {}
+            rows = []
+            for photo in chunk:
+                photo_tags[photo['file']] = self._tag_list(photo['tags'])
+                rows.append(dict(photo, album_id = album_id, tags = ','.join(photo_tags[photo['file']]), 
+                    widths = ','.join([str(w) for w in self._tag_list(photo.get('widths'))])))
+            chunk = rows
+            cursor.executemany("insert into photo(album_id, file, width, height, thumb_width, thumb_height, caption, tags, rating, favorite, date_time, widths) values "
+                + "(:album_id, :file, :width, :height, :thumb_width, :thumb_height, :caption, :tags, :rating, :favorite, :date_time, :widths) "
+                + "on conflict(album_id, file) do update set width = excluded.width, height = excluded.height, thumb_width = excluded.thumb_width, "
+                + "thumb_height = excluded.thumb_height, caption = excluded.caption, tags = excluded.tags, rating = excluded.rating, favorite = excluded.favorite, date_time = excluded.date_time, "
+                + "widths = excluded.widths "
+                + "where (photo.width, photo.height, photo.thumb_width, photo.thumb_height, photo.caption, photo.tags, photo.rating, photo.favorite, photo.date_time, photo.widths) "
+                + "is not (excluded.width, excluded.height, excluded.thumb_width, excluded.thumb_height, excluded.caption, excluded.tags, excluded.rating, excluded.favorite, excluded.date_time, excluded.widths)", 
+                chunk)
+
+            changed = [photo['file'] for photo in chunk if photo['file'] not in existing or existing[photo['file']] != photo['tags']]
+            if changed:
+                cursor.execute("select file, id from photo where album_id = ? and file in (%s)" % ','.join(['?'] * len(changed)), [album_id] + changed)
+                photo_ids = dict(cursor.fetchall())
+                cursor.executemany("delete from photo_tag where photo_id = ?", [(photo_ids[file],) for file in changed])
+                cursor.executemany("insert or ignore into photo_tag(photo_id, tag) values (?, ?)", 
+                    [(photo_ids[file], tag) for file in changed for tag in self._tag_keys(photo_tags[file])])
+
+    def _tag_list(self, tags):
+        """tags (or widths) as a list, album.json files saved by older imports may hold them comma joined"""
+        if not tags:
+            return []
+        if isinstance(tags, str):
+            return [tag for tag in tags.split(',') if tag]
+        return tags
+
+    def _tag_keys(self, tags):
+        """tags as stored in the photo_tag and album_tag tables, trimmed and lower cased so restricted tags match in any case"""
+        return set([tag.strip().lower() for tag in tags if tag.strip()])
+
+    def _delete_missing(self, cursor, album_id, files, folder_names):
+        """deletes the photos and sub albums of an album which are no longer in its folder"""
+        files = set(files)
+        cursor.execute("select file, id from photo where album_id = ?", (album_id,))
+        cursor.executemany("delete from photo where id = ?", [(id,) for file, id in cursor.fetchall() if file not in files])
+
+        #sub albums whose folder is gone, their photos are removed with the rogue photos
+        cursor.execute("select id, name from album where parent_id = ?", (album_id,))
+        stale = [(row[0],) for row in cursor.fetchall() if row[1] not in folder_names]
+        if stale:
+            cursor.executemany("with recursive sub(id) as (select ? union all select album.id from album, sub where album.parent_id = sub.id) "
+                + "delete from album where id in (select id from sub)", stale)
+
+    def generation(self):
+        """returns the import generation shared by all processes using the db"""
+        return self._connection().execute("select value from generation where id = 1").fetchone()[0]
+
+    def _restrict_tags(self, security_tags):
+        """returns the restricted tags still applying to a user with security_tags"""
+        restrict_tags = self._tag_keys(self.config['restrictTags'])
+        return sorted(restrict_tags - self._tag_keys(security_tags))
+
     def _restrict_sql(self, tables, security_tags = []):
-        restrict_tags = self.config['restrictTags'].copy()
-        for stag in security_tags:
-            if stag in restrict_tags:
-                restrict_tags.remove(stag)
+        restrict_tags = self._restrict_tags(security_tags)
 
         restrict_sql = " "
-        for table in tables:
-            for rtag in restrict_tags:
-                restrict_sql = restrict_sql + "and " + table + ".tags not like '%" + rtag + "%' "
+        if restrict_tags:
+            #tags come from the config, quote them as sql literals so the statement text stays cacheable
+            in_sql = ','.join(["'%s'" % rtag.replace("'", "''") for rtag in restrict_tags])
+            for table in tables:
+                restrict_sql = restrict_sql + ("and not exists (select 1 from %s_tag where %s_tag.%s_id = %s.id and %s_tag.tag in (%s)) " 
+                    % (table, table, table, table, table, in_sql))
         #self.logger.info("%s %s -> %s" % (str(security_tags), str(restrict_tags), restrict_sql))
         return restrict_sql
 
@@ -64,14 +270,26 @@ class Db:
         """
         returns a single photo
         /<album>/<photo> or /<album>/thumbs/<photo> ->
+        results are cached by album, photo and the restricted tags applying to the user until the next import
         """
+        generation = self.generation()
+        key = (album, photo, frozenset(self._restrict_tags(security_tags)))
+        p = self.photo_cache.get(key, generation, False)
+        if p is False:
+            p = self._search_photo(album, photo, security_tags)
+            self.photo_cache.put(key, p, generation)
+            stats = self.photo_cache.stats()
+            if stats['misses'] % 1000 == 0:
+                self.logger.info("Photo cache: %(size)d entries, %(hits)d hits, %(misses)d misses, hit rate %(hit_rate).2f" % stats)
+        return p
+
+    def _search_photo(self, album, photo, security_tags = []):
+        cursor = self._connection().cursor()
         try:
-            conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES)
-            cursor = conn.cursor()
             
             if album:
                 cursor.execute("select album.base_path, album.path, photo.file from photo, album " 
-                + "where photo.file = :file and album.name = :album" + self._restrict_sql(['photo'], security_tags), 
+                + "where photo.file = :file and album.name = :album and photo.album_id = album.id" + self._restrict_sql(['photo'], security_tags), 
                 {'file': photo, 'album': album})
                 p = cursor.fetchone()
                 if p == None: #error
@@ -79,18 +297,17 @@ class Db:
                 else:
                     return p
         finally:
-            conn.commit()
             cursor.close()
-            conn.close()
 
-    def search_photos(self, album = None, security_tags = [], tags = None):
+    def search_photos(self, album = None, security_tags = [], tags = None, after = None, limit = None):
         """
         returns a list of matching albums and photos
         /<album> -> 
+        :param tuple after: keyset cursor (date_time, id) of the last photo of the previous page
+        :param int limit: page size, when there are more photos result['next'] is the cursor of the next page
         """
+        cursor = self._connection().cursor()
         try:
-            conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES)
-            cursor = conn.cursor()
 
             if album:
                 cursor.execute("select * from album where (name = :name or alias = :name)" + self._restrict_sql(['album'], security_tags), {'name': album})
@@ -107,30 +324,189 @@ class Db:
                     #select photo.*, album.name from photo, album where photo.tags like '%ak%' and photo.rating >= 2
                     
                     sql_prefix = "select photo.*, album.name as album_name from photo, album where "
-                    sql_suffix = " and photo.album_id = album.id and (photo.rating >= 1 or photo.favorite == 1) " + self._restrict_sql(['photo'], security_tags) + " order by date(photo.date_time) asc"
+                    sql_suffix = " and photo.album_id = album.id and (photo.rating >= 1 or photo.favorite == 1) " + self._restrict_sql(['photo'], security_tags)
+                    params = {'album_id': album_id}
+                    #virtual albums are read from their materialized photos, in the order of the album_photo key
+                    order = "photo.date_time, photo.id"
+                    if album_sql != None:
+                        sql_prefix = "select photo.*, album.name as album_name from album_photo, photo, album where "
+                        order = "album_photo.date_time, album_photo.photo_id"
+                    if after:
+                        sql_suffix = sql_suffix + "and (%s) > (:after_date_time, :after_id) " % order
+                        params['after_date_time'], params['after_id'] = after
+                    sql_suffix = sql_suffix + "order by %s" % order
+                    if limit:
+                        #one more row tells if there is a next page
+                        sql_suffix = sql_suffix + " limit :limit"
+                        params['limit'] = limit + 1
                     if album_sql == None:                
-                        cursor.execute("select * from album where parent_id = :album_id", {'album_id': album_id})
-                        result['folders'] = self.rows2map(cursor.fetchall(), cursor)
-                        cursor.execute(sql_prefix + "photo.album_id = :album_id" + sql_suffix, {'album_id': album_id})
+                        if after:
+                            result['folders'] = []
+                        else:
+                            cursor.execute("select * from album where parent_id = :album_id", {'album_id': album_id})
+                            result['folders'] = self.rows2map(cursor.fetchall(), cursor)
+                        cursor.execute(sql_prefix + "photo.album_id = :album_id" + sql_suffix, params)
                     else:
                         result['folders'] = []
-                        cursor.execute(sql_prefix + album_sql + sql_suffix)
+                        if album['refreshed'] == None:
+                            #custom_sql set by hand since the last import
+                            with self._connection():
+                                self._refresh_virtual_album(cursor, album)
+                        cursor.execute(sql_prefix + "album_photo.album_id = :album_id and photo.id = album_photo.photo_id" + sql_suffix, params)
                     result['photos'] = self.rows2map(cursor.fetchall(), cursor)
+                    result['next'] = None
+                    if limit and len(result['photos']) > limit:
+                        result['photos'] = result['photos'][:limit]
+                        last = result['photos'][-1]
+                        result['next'] = (last['date_time'], last['id'])
                     return result
                 else:
                     return {'album': {'name': 'Search results'}, 'folders': self.rows2map(albums, cursor), 'photos': []}
         finally:
-            conn.commit()
             cursor.close()
-            conn.close()
         
+    def refresh_virtual_albums(self):
+        """
+        materializes the photos of all the albums with a custom_sql, returns their name, photo count, refresh time
+        and error if their custom_sql failed
+        """
+        conn = self._connection()
+        cursor = conn.cursor()
+        try:
+            with conn:
+                stats = self._refresh_virtual_albums(cursor)
+                cursor.execute("update generation set value = value + 1 where id = 1")
+                return stats
+        finally:
+            cursor.close()
+
+    def _refresh_virtual_albums(self, cursor, tree_id = None):
+        """
+        refreshes the virtual albums, with tree_id only those the import of that album tree may have changed
+        """
+        cursor.execute("select * from album where custom_sql is not null")
+        stats = []
+        for album in self.rows2map(cursor.fetchall(), cursor):
+            album_stats = self._refresh_virtual_album(cursor, album, tree_id)
+            if album_stats:
+                stats.append(album_stats)
+        return stats
+
+    def _refresh_virtual_album(self, cursor, album, tree_id = None):
+        """
+        materializes the photos of a virtual album, returns None if tree_id is given and none of its photos can have changed
+        a failing custom_sql is logged and kept in album.refresh_error, it does not fail the import
+        """
+        #should be the first where clause: ie "photo.tags like '%ak%' and photo.rating >= 2" in:
+        #select photo.*, album.name from photo, album where photo.tags like '%ak%' and photo.rating >= 2
+        start = time.time()
+        cursor.execute("savepoint virtual_album")
+        try:
+            if tree_id is not None and not self._is_virtual_album_touched(cursor, album, tree_id):
+                cursor.execute("release virtual_album")
+                return None
+            cursor.execute("delete from album_photo where album_id = :id", album)
+            cursor.execute("insert or ignore into album_photo(album_id, date_time, photo_id) select :id, photo.date_time, photo.id from photo, album where " 
+                + album['custom_sql'] + " and photo.album_id = album.id and (photo.rating >= 1 or photo.favorite == 1)", album)
+            photo_count = cursor.rowcount
+            refresh_ms = (time.time() - start) * 1000
+            cursor.execute("update album set refreshed = ?, refresh_ms = ?, photo_count = ?, refresh_error = null where id = ?", (time.time(), refresh_ms, photo_count, album['id']))
+            self._layout_album(cursor, album['id'])
+            cursor.execute("release virtual_album")
+        except sqlite3.Error as e:
+            #the previous photos of the album are kept
+            cursor.execute("rollback to virtual_album")
+            cursor.execute("release virtual_album")
+            refresh_ms = (time.time() - start) * 1000
+            cursor.execute("update album set refreshed = ?, refresh_ms = ?, refresh_error = ? where id = ?", (time.time(), refresh_ms, str(e), album['id']))
+            self.logger.error("Virtual album %s failed: %s" % (album['name'], e))
+            return {'name': album['name'], 'photo_count': album['photo_count'], 'refresh_ms': refresh_ms, 'error': str(e)}
+        self.logger.info("Refreshed virtual album %s: %d photos in %.1f ms" % (album['name'], photo_count, refresh_ms))
+        return {'name': album['name'], 'photo_count': photo_count, 'refresh_ms': refresh_ms, 'error': None}
+
+    def _is_virtual_album_touched(self, cursor, album, tree_id):
+        """
+        a virtual album may have changed with the import of an album tree if its custom_sql matches a photo of the tree,
+        it holds a photo of the tree or it lost photos (deleted by the import)
+        """
+        cursor.execute("with recursive tree(id) as (select :tree_id union all select album.id from album, tree where album.parent_id = tree.id) "
+            + "select exists (select 1 from photo, album where " + album['custom_sql'] + " and photo.album_id = album.id and album.id in (select id from tree)) "
+            + "or exists (select 1 from album_photo, photo where album_photo.album_id = :id and photo.id = album_photo.photo_id and photo.album_id in (select id from tree)) "
+            + "or (select count(*) from album_photo where album_photo.album_id = :id) is not :photo_count", 
+            {'tree_id': tree_id, 'id': album['id'], 'photo_count': album['photo_count']})
+        return cursor.fetchone()[0] == 1
+
+    def _layout_album(self, cursor, album_id):
+        """
+        stores the layouts of the selected album photos, in page order, for every combination of restricted tags
+        which can hide photos from a viewer
+        """
+        restrict_tags = sorted(self._tag_keys(self.config['restrictTags']))
+        in_sql = ','.join(["'%s'" % rtag.replace("'", "''") for rtag in restrict_tags])
+        restricted_sql = "(select group_concat(tag) from photo_tag where photo_tag.photo_id = photo.id and photo_tag.tag in (%s)) as restricted" % in_sql
+        cursor.execute("select custom_sql from album where id = ?", (album_id,))
+        if cursor.fetchone()[0] == None:
+            cursor.execute("select photo.id, photo.thumb_width, photo.thumb_height, " + restricted_sql + " from photo "
+                + "where photo.album_id = ? and (photo.rating >= 1 or photo.favorite == 1) order by photo.date_time, photo.id", (album_id,))
+        else:
+            cursor.execute("select photo.id, photo.thumb_width, photo.thumb_height, " + restricted_sql + " from album_photo, photo "
+                + "where album_photo.album_id = ? and photo.id = album_photo.photo_id order by album_photo.date_time, album_photo.photo_id", (album_id,))
+        photos = self.rows2map(cursor.fetchall(), cursor)
+        rows = []
+        for n in range(len(restrict_tags) + 1):
+            for hidden in itertools.combinations(restrict_tags, n):
+                visible = [photo for photo in photos if not set(hidden) & set((photo['restricted'] or '').split(','))]
+                for l in layout.layouts(visible, self.config):
+                    rows.append((album_id, ','.join(hidden), l['viewport'], l['width'], l['height'], json.dumps(l['positions'], separators = (',', ':'))))
+        cursor.execute("delete from album_layout where album_id = ?", (album_id,))
+        cursor.executemany("insert into album_layout(album_id, hidden, viewport, width, height, positions) values (?, ?, ?, ?, ?, ?)", rows)
+
+    def album_layouts(self, album_id, security_tags = []):
+        """
+        returns the layouts of the album photos visible with security_tags, smallest viewport first
+        albums imported before layouts existed, or laid out for other layoutWidths, are laid out on first use
+        """
+        hidden = ','.join(self._restrict_tags(security_tags))
+        conn = self._connection()
+        cursor = conn.cursor()
+        try:
+            for attempt in range(2):
+                cursor.execute("select viewport, width, height, positions from album_layout where album_id = ? and hidden = ? order by viewport", (album_id, hidden))
+                rows = cursor.fetchall()
+                if [row[0] for row in rows] == layout.layout_widths(self.config) or attempt == 1:
+                    break
+                with conn:
+                    self._layout_album(cursor, album_id)
+            return [{'viewport': viewport, 'width': width, 'height': height, 'positions': {int(id): p for id, p in json.loads(positions).items()}} 
+                for viewport, width, height, positions in rows]
+        finally:
+            cursor.close()
+
+    def search(self, query, security_tags = [], limit = 500):
+        """
+        returns the selected photos matching a full text query on caption, tags, file and album name, best first
+        every word of the query must match, as a word prefix
+        """
+        words = [w.replace('"', '') for w in query.split()]
+        match = ' '.join(['"%s"*' % w for w in words if w])
+        if not match:
+            return []
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute("select photo.*, album.name as album_name from photo_fts, photo, album "
+                + "where photo_fts match :match and photo.id = photo_fts.rowid and photo.album_id = album.id "
+                + "and (photo.rating >= 1 or photo.favorite == 1) " + self._restrict_sql(['photo', 'album'], security_tags)
+                + "order by photo_fts.rank limit :limit", {'match': match, 'limit': limit})
+            return self.rows2map(cursor.fetchall(), cursor)
+        finally:
+            cursor.close()
+
     def list_albums(self):
         """
         returns a list of albums
         """
+        cursor = self._connection().cursor()
         try:
-            conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES)
-            cursor = conn.cursor()
             
             cursor.execute("select name, path, tags from album where parent_id is null order by name")
             p = cursor.fetchall()
@@ -139,11 +515,105 @@ class Db:
             else:
                 return {'folders': self.rows2map(p, cursor), 'album': {'name': 'list'}}
         finally:
-            conn.commit()
             cursor.close()
-            conn.close()
 
 
+    def enqueue_job(self, action, path, force = False, start = False, base_path = None):
+        """
+        queues a parse or import of an album path for the worker, returns the job id
+        with start the job is created running and owned by this process, for callers running it themselves
+        fails if the same path, a folder above it or a folder in it is already queued or running
+        """
+        conn = self._connection()
+        now = time.time()
+        try:
+            with conn:
+                #take the write lock first so two processes can not queue overlapping paths
+                conn.execute("begin immediate")
+                cursor = conn.execute("select path from job where status in ('queued', 'running') "
+                    + "and (path = :path or substr(path, 1, length(:path) + 1) = :path || '/' or substr(:path, 1, length(path) + 1) = path || '/') limit 1", {'path': path})
+                active = cursor.fetchone()
+                if active:
+                    raise Exception("Album %s is already queued with %s" % (path, active[0]))
+                cursor = conn.execute("insert into job(action, path, base_path, force, status, created, started, owner) values (?, ?, ?, ?, ?, ?, ?, ?)", 
+                    (action, path, base_path, int(force), 'running' if start else 'queued', now, now if start else None, os.getpid() if start else None))
+                return cursor.lastrowid
+        except sqlite3.IntegrityError:
+            raise Exception("Album %s is already queued" % path)
+
+    def claim_job(self):
+        """marks the oldest queued job as running and returns it, None if the queue is empty"""
+        conn = self._connection()
+        with conn:
+            #take the write lock first so two workers can not claim the same job
+            conn.execute("begin immediate")
+            cursor = conn.execute("select * from job where status = 'queued' order by id limit 1")
+            jobs = self.rows2map(cursor.fetchall(), cursor)
+            if not jobs:
+                return None
+            job = jobs[0]
+            job['status'] = 'running'
+            job['started'] = time.time()
+            job['owner'] = os.getpid()
+            conn.execute("update job set status = 'running', started = ?, owner = ? where id = ?", (job['started'], job['owner'], job['id']))
+            return job
+
+    def requeue_running_jobs(self):
+        """
+        jobs left running by a stopped worker or scan are queued again, jobs whose owner process is still running
+        (a scan parsing its album) are left alone
+        """
+        conn = self._connection()
+        with conn:
+            conn.execute("begin immediate")
+            stale = [(id,) for id, owner in conn.execute("select id, owner from job where status = 'running'").fetchall() if not self._is_running(owner)]
+            conn.executemany("update job set status = 'queued', processed = 0, owner = null where id = ?", stale)
+            return len(stale)
+
+    def _is_running(self, pid):
+        """the processes sharing the db file run on the same host"""
+        if not pid:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            #running under another user
+            pass
+        return True
+
+    def update_job(self, id, **fields):
+        """updates progress (processed, total) or outcome (status, album_name, error, finished) of a job"""
+        conn = self._connection()
+        with conn:
+            conn.execute("update job set %s where id = :id" % ', '.join(["%s = :%s" % (k, k) for k in fields]), dict(fields, id = id))
+
+    def get_job(self, id):
+        cursor = self._connection().cursor()
+        try:
+            cursor.execute("select * from job where id = :id", {'id': id})
+            jobs = self.rows2map(cursor.fetchall(), cursor)
+            if not jobs:
+                return None
+            return jobs[0]
+        finally:
+            cursor.close()
+
+    def load_scan_snapshot(self):
+        """returns the folder snapshot of the library scanner: {path: {mtime, photos, subdirs}}"""
+        snapshot = {}
+        for path, mtime, photos, subdirs in self._connection().execute("select path, mtime, photos, subdirs from scan_dir"):
+            snapshot[path] = {'mtime': mtime, 'photos': photos, 'subdirs': json.loads(subdirs)}
+        return snapshot
+
+    def save_scan_snapshot(self, changed, removed):
+        conn = self._connection()
+        with conn:
+            conn.executemany("insert or replace into scan_dir(path, mtime, photos, subdirs) values (?, ?, ?, ?)", 
+                [(path, e['mtime'], e['photos'], json.dumps(e['subdirs'])) for path, e in changed.items()])
+            conn.executemany("delete from scan_dir where path = ?", [(path,) for path in removed])
+
     def rows2map(self, rows, cursor):
         names = [description[0] for description in cursor.description]
         result = []
@@ -156,9 +626,8 @@ class Db:
         """
         returns an user(id, tags)
         """
+        cursor = self._connection().cursor()
         try:
-            conn = sqlite3.connect(self.db_file, detect_types=sqlite3.PARSE_DECLTYPES)
-            cursor = conn.cursor()
             cursor.execute("select * from user where id = :id", {'id': id})
             p = cursor.fetchone()
             if p == None: #error
@@ -166,6 +635,4 @@ class Db:
             else:
                 return p
         finally:
-            conn.commit()
-            cursor.close()
-            conn.close()
\ No newline at end of file
+            cursor.close()
\ No newline at end of file
@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
 import json
-import os, argparse
+import os, argparse, mimetypes, threading, time
+from urllib.parse import quote
 import logging, logging.config
 
 from db import Db
 from albumParser import AlbumParser
+from cache import LruCache
+from scanner import LibraryScanner
+from metrics import Metrics
+import layout
 
 
-from flask import Flask, redirect, request, url_for, render_template, send_file, make_response, send_from_directory, session
+from flask import Flask, redirect, request, url_for, render_template, send_file, make_response, send_from_directory, session, jsonify, g
 from oauthlib.oauth2 import WebApplicationClient
 import requests
+from requests.adapters import HTTPAdapter
 from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_cache_control_header
 
 scriptPath = os.path.dirname(os.path.abspath(__file__))
-config = json.load(open(os.path.join(scriptPath, 'config.json'), 'r'))
+#FOTOS_CONFIG points to another config file, used by the benchmarks
+config = json.load(open(os.environ.get('FOTOS_CONFIG', os.path.join(scriptPath, 'config.json')), 'r'))
 logging.config.dictConfig(config['logging'])
 logger = logging.getLogger('fotos')
 
@@ -21,12 +29,29 @@ logger = logging.getLogger('fotos')
 # Flask app setup
 app = Flask(__name__)
 app.secret_key = config["flaskSecret"]
+#image delivery: flask (default), xsendfile (apache mod_xsendfile) or xaccel (nginx X-Accel-Redirect)
+imageDelivery = config.get('imageDelivery', 'flask')
+app.config['USE_X_SENDFILE'] = (imageDelivery == 'xsendfile')
 
 # OAuth2 client setup
 client = WebApplicationClient(config['googleOauth']['clientId'])
+#pooled keep-alive connections to the provider shared by all the oauth calls
+http = requests.Session()
+http.mount('https://', HTTPAdapter(pool_maxsize = 10))
+httpTimeout = config['googleOauth'].get('timeout', 10)
+providerCfg = {'value': None, 'expires': 0}
+providerCfgLock = threading.Lock()
 
 parser = AlbumParser(config, logger)
 db = Db(config, logger)
+#prepared album pages by album and restricted tags, dropped on every import since virtual albums span other albums
+albumCache = LruCache(config.get('albumCacheSize', 100))
+
+#request latency, db query and cache statistics for /metrics, stage timings for the Server-Timing header
+metrics = Metrics()
+metrics.instrument(db, ['generation', '_search_photo', 'search_photos', 'album_layouts', 'search', 'list_albums', 'get_user'])
+metrics.caches['album'] = lambda: albumCache.stats()
+metrics.caches['photo'] = lambda: db.photo_cache.stats()
 
 def login(initial_url):
     # Find out what URL to hit for Google login
@@ -63,11 +88,12 @@ def callback():
         redirect_url=request.base_url,
         code=code,
     )
-    token_response = requests.post(
+    token_response = http.post(
         token_url,
         headers=headers,
         data=body,
         auth=(config['googleOauth']['clientId'], config['googleOauth']['clientSecret']),
+        timeout=httpTimeout,
     )
 
     # Parse the tokens!
@@ -78,7 +104,7 @@ def callback():
     # including their Google Profile Image and Email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = http.get(uri, headers=headers, data=body, timeout=httpTimeout)
 
     # We want to make sure their email is verified.
     # The user authenticated with Google, authorized our
@@ -111,7 +137,22 @@ def logout():
     return redirect(url_for("index"))
 
 def get_google_provider_cfg():
-    return requests.get(config['googleOauth']['discoveryURL']).json()
+    """
+    returns the discovery document, cached for the max-age of its Cache-Control header (1 hour if missing),
+    not cached at all with no-store or no-cache
+    the lock makes concurrent logins wait for a single fetch
+    """
+    with providerCfgLock:
+        if providerCfg['value'] is None or time.time() >= providerCfg['expires']:
+            response = http.get(config['googleOauth']['discoveryURL'], timeout=httpTimeout)
+            response.raise_for_status()
+            cache_control = parse_cache_control_header(response.headers.get('Cache-Control'))
+            max_age = cache_control.max_age
+            if cache_control.no_store or cache_control.no_cache:
+                max_age = 0
+            providerCfg['value'] = response.json()
+            providerCfg['expires'] = time.time() + (max_age if max_age is not None else 3600)
+        return providerCfg['value']
 
 def get_remote_ip(request):
     if 'X-Forwarded-For' in request.headers:
@@ -120,6 +161,10 @@ def get_remote_ip(request):
         return request.remote_addr
 
 def authenticate():
+    with metrics.timer('auth'):
+        return _authenticate()
+
+def _authenticate():
     if 'user' in session:
         current_user = session['user']
         logger.info("%s - %s %s %s" % (get_remote_ip(request), current_user['email'], request.method, request.url))
@@ -129,11 +174,28 @@ def authenticate():
         #https://stackoverflow.com/questions/15093593/request-path-and-url-for-dont-match-up-in-flask-under-mod-wsgi
         return None, login(request.script_root + request.full_path)
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    metrics.start_request()
+
+@app.after_request
+def server_timing(r):
+    """
+    Server-Timing header with the stages of the request (auth, db, layout, render, derive, send) and its total duration
+    """
+    total = time.perf_counter() - g.start
+    r.headers['Server-Timing'] = metrics.server_timing(total)
+    metrics.observe('fotos_request_seconds', total, endpoint = request.endpoint or 'none', status = r.status_code)
+    return r
+
 @app.after_request
 def add_header(r):
     """
-    disable caching
+    disable caching, except for responses which set their own private cache policy (photos and thumbs)
     """
+    if r.cache_control.private:
+        return r
     r.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     r.headers["Pragma"] = "no-cache"
     r.headers["Expires"] = "0"
@@ -147,6 +209,22 @@ def handle_exception(e):
         return e
     return render_template("error.html", e=e), 403
 
+@app.route("/metrics")
+def metrics_text():
+    """
+    prometheus text metrics of this process: request latency, db queries and cache hit rates
+    """
+    user, redirect_response = authenticate()
+    if not user:
+        return redirect_response
+    user_tags = user['tags']
+
+    if not 'admin' in user_tags:
+        raise Exception("Admin required for metrics")
+    response = make_response(metrics.render())
+    response.headers['Content-type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -185,9 +263,7 @@ def parse():
     path = request.args.get('path', None)
     force = request.args.get('force', 'false')
     force = (force == 'true')
-    album = parser.parse(path, force)
-    db.create_album(album)
-    return redirect(url_for('album', album = album['name']))
+    return enqueue_job('parse', path, force)
 
 @app.route("/import")
 def import_album():
@@ -202,11 +278,112 @@ def import_album():
     if not 'admin' in user_tags:
         raise Exception("Admin required for import operation")
     path = request.args.get('path', None)
-    album = parser.import_album(path)
-    db.create_album(album)
-    redirect_url = url_for('album', album = album['name'])
-    logger.info("Redirecting to: %s" % redirect_url)
-    return redirect(redirect_url)
+    return enqueue_job('import', path)
+
+@app.route("/refresh")
+def refresh_virtual_albums():
+    """
+    materializes the virtual (custom_sql) albums again, returns their photo count and refresh time
+    """
+    user, redirect_response = authenticate()
+    if not user:
+        return redirect_response
+    user_tags = user['tags']
+
+    if not 'admin' in user_tags:
+        raise Exception("Admin required for refresh operation")
+    return jsonify(db.refresh_virtual_albums())
+
+def enqueue_job(action, path, force = False):
+    """queues the action for the worker and returns the job id at once"""
+    if not path:
+        raise Exception("Missing path")
+    path = path.rstrip('/')
+    job_id = db.enqueue_job(action, path, force)
+    logger.info("Queued %s of %s as job %d" % (action, path, job_id))
+    return jsonify({'job': job_id, 'status': url_for('job_status', job_id = job_id)}), 202
+
+@app.route("/job/<int:job_id>")
+def job_status(job_id):
+    """
+    status of a parse or import job with photos processed, throughput (photos/s) and eta (s)
+    """
+    user, redirect_response = authenticate()
+    if not user:
+        return redirect_response
+    user_tags = user['tags']
+
+    if not 'admin' in user_tags:
+        raise Exception("Admin required for job status")
+    job = db.get_job(job_id)
+    if not job:
+        raise Exception("Missing job %s" % job_id)
+    job['throughput'] = None
+    job['eta'] = None
+    if job['started']:
+        elapsed = (job['finished'] or time.time()) - job['started']
+        if elapsed > 0 and job['processed']:
+            job['throughput'] = job['processed'] / elapsed
+            if job['status'] == 'running' and job['total']:
+                job['eta'] = max(job['total'] - job['processed'], 0) / job['throughput']
+    if job['album_name']:
+        job['album'] = url_for('album', album = job['album_name'])
+    return jsonify(job)
+
+def run_job(job, jobs = None):
+    """runs a claimed job, recording progress at most once per second, jobs is the number of parallel parse processes"""
+    logger.info("Running job %(id)d: %(action)s %(path)s" % job)
+    try:
+        if job['action'] == 'parse':
+            db.update_job(job['id'], total = parser.count_photos(job['path'], job['base_path']))
+            last = {'time': 0}
+            def progress(processed):
+                if time.time() - last['time'] >= 1:
+                    last['time'] = time.time()
+                    db.update_job(job['id'], processed = processed)
+            parser.progress = progress
+            album_name = db.import_records(parser.iter_parse(job['path'], job['force'] == 1, jobs, basePath = job['base_path']))
+            db.update_job(job['id'], status = 'done', album_name = album_name, processed = parser.processed, finished = time.time())
+        else:
+            #import reads album.json files, there are no parsed photos to count
+            album = parser.import_album(job['path'])
+            db.create_album(album)
+            db.update_job(job['id'], status = 'done', album_name = album['name'], finished = time.time())
+    except Exception as e:
+        logger.error(e, exc_info = 1)
+        db.update_job(job['id'], status = 'failed', error = str(e), finished = time.time())
+    finally:
+        parser.progress = None
+
+def scan():
+    """parses the albums found new or changed by the library scanner"""
+    scanner = LibraryScanner(config, logger, db)
+    for basePath, path in scanner.scan():
+        try:
+            job_id = db.enqueue_job('parse', path, start = True, base_path = basePath)
+        except Exception as e:
+            #queued by /parse meanwhile, the worker will handle it
+            logger.info(e)
+            continue
+        run_job(db.get_job(job_id))
+        if db.get_job(job_id)['status'] == 'done':
+            scanner.refresh(basePath, path)
+
+def worker():
+    """runs queued jobs one at a time, only one worker should run"""
+    requeued = db.requeue_running_jobs()
+    if requeued:
+        logger.info("Requeued %d interrupted jobs" % requeued)
+    try:
+        while True:
+            job = db.claim_job()
+            if job:
+                run_job(job)
+            else:
+                time.sleep(config.get('workerPollInterval', 2))
+    finally:
+        #also on ctrl-c or sigterm handled as an exception
+        db.close()
 
 @app.route("/<album>")
 def album(album):
@@ -224,19 +401,81 @@ def album(album):
         user_tags = list(set(tags) & set(user_tags))
     logger.info("user_tags: %s" % ','.join(user_tags))
 
-    result = db.search_photos(album, user_tags)
+    result = album_data(album, user_tags)
     if result:
-        for photo in result['photos']:
-            style = ''
-            if photo['thumb_width'] != config['thumbSizeSmall']:
-                style = 'width:%spx; ' % (int(photo['thumb_width']) + 6)
-            if photo['thumb_height'] != config['thumbSizeSmall']:
-                style = style + 'height:%spx; ' % (int(photo['thumb_height']) + 6)
-            photo['style'] = style
-        return render_template('album.html', data = result, config = config, user = user)
+        with metrics.timer('render'):
+            return render_template('album.html', data = result, config = config, user = user)
     else:
         raise Exception("Missing album %s" % album)
 
+def album_data(album, user_tags):
+    """returns the first page of album photos with their layout css, cached until the next import"""
+    generation = db.generation()
+    key = (album, frozenset(db._restrict_tags(user_tags)))
+    result = albumCache.get(key, generation)
+    if result is None:
+        result = db.search_photos(album, user_tags, limit = config.get('pageSize', 200))
+        if result:
+            layouts = db.album_layouts(result['album']['id'], user_tags) if 'id' in result['album'] else []
+            with metrics.timer('layout'):
+                for photo in result['photos']:
+                    photo['srcset'], photo['viewer_srcset'] = photo_srcset(photo)
+                    photo['sizes'] = layout.layout_sizes(layouts, photo)
+                result['layout_css'] = layout.layout_css(layouts, result['photos'])
+            result['next'] = encode_cursor(result.get('next'))
+            albumCache.put(key, result, generation)
+    return result
+
+def photo_srcset(photo):
+    """
+    returns the srcset of the thumb (thumb and ladder images) and of the viewer (ladder and album image)
+    """
+    ladder = []
+    for w in (photo.get('widths') or '').split(','):
+        if w:
+            ladder.append('%s %sw' % (url_for('photo_width', album = photo['album_name'], width = int(w), photo = photo['file']), w))
+    thumb = '%s %sw' % (url_for('thumb', album = photo['album_name'], photo = photo['file']), photo['thumb_width'])
+    full = '%s %sw' % (url_for('photo', album = photo['album_name'], photo = photo['file']), photo['width'])
+    return ', '.join([thumb] + ladder), ', '.join(ladder + [full])
+
+def encode_cursor(after):
+    """(date_time, id) keyset cursor to its url form"""
+    if after:
+        return '%s,%s' % after
+    return None
+
+def decode_cursor(after):
+    if after:
+        date_time, id = after.rsplit(',', 1)
+        return date_time, int(id)
+    return None
+
+@app.route("/api/<album>")
+def album_api(album):
+    """
+    a page of album photos as json: /api/<album>?after=<cursor>&limit=N
+    next is the cursor of the following page, null on the last page, css places the photos of the page in the album layout
+    """
+    user, redirect_response = authenticate()
+    if not user:
+        return redirect_response
+    user_tags = user['tags']
+
+    limit = max(1, min(request.args.get('limit', config.get('pageSize', 200), type = int), 1000))
+    result = db.search_photos(album, user_tags, after = decode_cursor(request.args.get('after')), limit = limit)
+    if not result:
+        raise Exception("Missing album %s" % album)
+    layouts = db.album_layouts(result['album']['id'], user_tags) if 'id' in result['album'] else []
+    photos = []
+    for photo in result['photos']:
+        srcset, viewer_srcset = photo_srcset(photo)
+        photos.append({'id': photo['id'], 'file': photo['file'], 'album_name': photo['album_name'], 'tags': photo['tags'], 
+            'thumb_width': photo['thumb_width'], 'thumb_height': photo['thumb_height'],
+            'srcset': srcset, 'viewer_srcset': viewer_srcset, 'sizes': layout.layout_sizes(layouts, photo),
+            'url': url_for('photo', album = photo['album_name'], photo = photo['file']), 
+            'thumb_url': url_for('thumb', album = photo['album_name'], photo = photo['file'])})
+    return jsonify({'photos': photos, 'css': layout.layout_css(layouts, result['photos'], grid = False), 'next': encode_cursor(result.get('next'))})
+
 @app.route("/css/album.css")
 def album_css():
     response = make_response(render_template('album.css', config = config))
@@ -251,11 +490,15 @@ def photo(album, photo):
 def thumb(album, photo):
     return _photo(album, photo, True)
 
+@app.route("/<album>/w/<int:width>/<photo>")
+def photo_width(album, photo, width):
+    return _photo(album, photo, width = width)
+
 @app.route("/favicon.ico")
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
-def _photo(album, photo, thumb = False):
+def _photo(album, photo, thumb = False, width = None):
     user, redirect_response = authenticate()
     if not user:
         return redirect_response
@@ -264,38 +507,135 @@ def _photo(album, photo, thumb = False):
     result = db.search_photo(album, photo, user_tags)
     if thumb:
         photo_file = os.path.join(result[0], result[1], config['albumDir'], config['thumbDir'], result[2])
+    elif width:
+        if width not in config.get('widthLadder', []):
+            raise Exception("Unknown width %s" % width)
+        photo_file = os.path.join(result[0], result[1], config['albumDir'], 'w%d' % width, result[2])
     else:
         photo_file = os.path.join(result[0], result[1], config['albumDir'], result[2])
-    return send_file(photo_file)
+    if parser.lazy and not os.path.lexists(photo_file):
+        #first request of this derivative, concurrent requests wait for the same resize
+        with metrics.timer('derive'):
+            parser.ensure_derivative(os.path.join(result[0], result[1]), result[2], thumb, width)
+    with metrics.timer('send'):
+        photo_file = negotiate_format(photo_file)
+        if imageDelivery == 'xaccel':
+            response = x_accel_file(photo_file)
+        else:
+            #strong etag and last-modified from the file mtime and size, answers 304 to if-none-match / if-modified-since
+            #with USE_X_SENDFILE the body is replaced by an X-Sendfile header
+            response = send_file(photo_file, etag = True, conditional = True, max_age = config.get('imageMaxAge', 86400))
+    #cached by the browser only, without revalidation until max-age: send_file sets public with max_age and no-cache without
+    response.cache_control.no_cache = None
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = config.get('imageMaxAge', 86400)
+    if config.get('modernFormats'):
+        response.vary.add('Accept')
+    return response
+
+def negotiate_format(photo_file):
+    """
+    returns the first modernFormats variant of photo_file explicitly accepted by the client and present on disk,
+    the jpeg otherwise (*/* does not count, it is sent by clients without webp support too)
+    """
+    accepted = [mimetype for mimetype, quality in request.accept_mimetypes if quality > 0]
+    for fmt in config.get('modernFormats', []):
+        if 'image/' + fmt.lower() in accepted:
+            variant = '%s.%s' % (photo_file, fmt.lower())
+            if os.path.exists(variant):
+                return variant
+    return photo_file
+
+def x_accel_file(photo_file):
+    """
+    empty response with an X-Accel-Redirect to the nginx internal location mapped in xAccelRedirect
+    (base path prefix -> internal uri prefix), nginx then streams the file
+    """
+    for prefix, location in config['xAccelRedirect'].items():
+        if photo_file.startswith(prefix):
+            stat = os.stat(photo_file)
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = quote(location + photo_file[len(prefix):])
+            response.headers['Content-Type'] = mimetypes.guess_type(photo_file)[0] or 'application/octet-stream'
+            response.set_etag('%x-%x' % (int(stat.st_mtime), stat.st_size))
+            response.last_modified = stat.st_mtime
+            return response.make_conditional(request)
+    raise Exception("No xAccelRedirect location for %s" % photo_file)
+
+@app.route("/search")
+def search():
+    """
+    full text search over photo captions, tags, file and album names: /search?q=
+    """
+    user, redirect_response = authenticate()
+    if not user:
+        return redirect_response
+    user_tags = user['tags']
+
+    q = request.args.get('q', '')
+    photos = db.search(q, user_tags)
+    #search results are not stored, laid out on each request
+    layouts = layout.layouts(photos, config)
+    for photo in photos:
+        photo['srcset'], photo['viewer_srcset'] = photo_srcset(photo)
+        photo['sizes'] = layout.layout_sizes(layouts, photo)
+    result = {'album': {'name': 'Search %s' % q}, 'folders': [], 'photos': photos, 'layout_css': layout.layout_css(layouts, photos)}
+    return render_template('album.html', data = result, config = config, user = user)
 
 @app.route("/tag/<tag>")
 def tags(tag):
-    return 'tag %s' % tag
+    return redirect(url_for('search', q = tag))
 
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser()
-    argparser.add_argument('-a', '--action', required=True, choices=['import', 'parse', 'serve'], help='Action: import existing album.json | parse album | serve https://127.0.0.1:5000')   
+    argparser.add_argument('-a', '--action', required=True, choices=['import', 'parse', 'serve', 'worker', 'scan', 'refresh', 'warm'], help='Action: import existing album.json | parse album | serve https://127.0.0.1:5000 | worker running queued /parse and /import jobs | scan paths and parse new or changed albums | refresh virtual albums | warm creates the missing photos and thumbs of a parsed album (lazyDerivatives)')   
     argparser.add_argument('-p', '--path', help='Album path')
     argparser.add_argument('-f', '--force', action="store_true", help='Force operation')
+    argparser.add_argument('-i', '--interval', type=int, help='Scan again every interval seconds instead of once')
+    argparser.add_argument('-j', '--jobs', type=int, help='Parallel parse processes, 0 for one per cpu (default: config parseJobs)')
     args = argparser.parse_args()
 
     action=args.action
     album_path=args.path
-    if album_path.endswith('/'):
+    if album_path and album_path.endswith('/'):
         album_path = album_path[:-1]
     force=args.force
 
-    if action != "server" and not album_path:
-        argparser.error("-p path is required for import or parse")
+    if action in ['import', 'parse', 'warm'] and not album_path:
+        argparser.error("-p path is required for import, parse or warm")
 
     if action == 'import':
         album = parser.import_album(album_path)
         db.create_album(album)
         logger.info("Imported /%s" % album['name'])
     if action == 'parse':
-        print(album_path)
-        album = parser.parse(album_path, force)
-        db.create_album(album)
-        logger.info("Parsed /%s" % album['name'])
-    if action == "server":
-        app.run(ssl_context="adhoc")
\ No newline at end of file
+        #through the job table, so the worker and the scanner do not parse the same folders meanwhile
+        job_id = db.enqueue_job('parse', album_path, force, start = True)
+        run_job(db.get_job(job_id), args.jobs)
+        job = db.get_job(job_id)
+        if job['status'] != 'done':
+            raise Exception("Parse of %s failed: %s" % (album_path, job['error']))
+        logger.info("Parsed /%s" % job['album_name'])
+    if action == 'warm':
+        parser.warm(album_path, args.jobs)
+    if action == "serve":
+        app.run(ssl_context="adhoc")
+    if action == "worker":
+        worker()
+    if action == "refresh":
+        for stats in db.refresh_virtual_albums():
+            if stats['error']:
+                print("%(name)s: failed in %(refresh_ms).1f ms: %(error)s" % stats)
+            else:
+                print("%(name)s: %(photo_count)d photos in %(refresh_ms).1f ms" % stats)
+    if action == "scan":
+        try:
+            scan()
+            while args.interval:
+                time.sleep(args.interval)
+                scan()
+        finally:
+            db.close()
+    if action in ['import', 'parse', 'warm', 'refresh']:
+        db.close()
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""
+justified layout of album thumbs: photos are put in rows of the same height, each row scaled to fill the grid width
+"""
+
+#body margins and the vertical scrollbar, the grid of a viewport width is that much narrower
+VIEWPORT_MARGIN = 40
+
+def justified_layout(photos, width, row_height):
+    """
+    positions of the photos, in order, in rows filled to width, the last row keeps row_height
+    returns ({photo id: [x, y, width, height]}, total height)
+    """
+    positions = {}
+    y = 0
+    row = []
+    row_width = 0
+    for photo in photos:
+        if photo['thumb_height']:
+            aspect = photo['thumb_width'] / photo['thumb_height']
+        else:
+            aspect = 1
+        row.append((photo['id'], aspect))
+        row_width = row_width + aspect * row_height
+        if row_width >= width:
+            height = int(round(row_height * width / row_width))
+            _place_row(positions, row, y, height, width)
+            y = y + height
+            row = []
+            row_width = 0
+    if row:
+        _place_row(positions, row, y, row_height, None)
+        y = y + row_height
+    return positions, y
+
+def _place_row(positions, row, y, height, width):
+    x = 0
+    for i, (id, aspect) in enumerate(row):
+        w = int(round(aspect * height))
+        if width and i == len(row) - 1:
+            #rounding leftovers go to the last photo, so the row ends exactly at width
+            w = width - x
+        positions[id] = [x, y, w, height]
+        x = x + w
+
+def layout_widths(config):
+    """the viewport widths laid out, smallest first"""
+    return sorted(config.get('layoutWidths', [360, 768, 1280, 1920]))
+
+def layouts(photos, config):
+    """the layouts of the photos for each of the layout widths, smallest first"""
+    row_height = config.get('layoutRowHeight', config['thumbSizeSmall'] + 6)
+    result = []
+    for viewport in layout_widths(config):
+        width = viewport - VIEWPORT_MARGIN
+        positions, height = justified_layout(photos, width, row_height)
+        result.append({'viewport': viewport, 'width': width, 'height': height, 'positions': positions})
+    return result
+
+def layout_css(layouts, photos, grid = True):
+    """
+    css rules placing the photos (#p<id>) and sizing the grid for each layout, the smallest layout applies
+    below all viewport widths
+    """
+    rules = []
+    for i, layout in enumerate(layouts):
+        css = []
+        if grid:
+            css.append('.grid{width:%dpx;height:%dpx}' % (layout['width'], layout['height']))
+        positions = layout['positions']
+        for photo in photos:
+            if photo['id'] in positions:
+                css.append('#p%d{left:%dpx;top:%dpx;width:%dpx;height:%dpx}' % ((photo['id'],) + tuple(positions[photo['id']])))
+        if i == 0:
+            rules.extend(css)
+        else:
+            rules.append('@media (min-width:%dpx){%s}' % (layout['viewport'], ''.join(css)))
+    return '\n'.join(rules)
+
+def layout_sizes(layouts, photo):
+    """
+    img sizes attribute of a photo, its width in each layout under the media conditions of layout_css
+    so the browser picks the srcset candidate of the displayed width, the widest viewport comes first
+    """
+    sizes = []
+    for i, layout in enumerate(layouts):
+        position = layout['positions'].get(photo['id'])
+        width = position[2] if position else photo['thumb_width']
+        if i == 0:
+            sizes.append('%dpx' % width)
+        else:
+            sizes.append('(min-width:%dpx) %dpx' % (layout['viewport'], width))
+    if not sizes:
+        return '%dpx' % photo['thumb_width']
+    return ', '.join(reversed(sizes))
@@ -0,0 +1,102 @@
+import threading, time, functools
+from contextlib import contextmanager
+
+class Metrics:
+    """
+    in process request and db query histograms and cache statistics, rendered in the prometheus text format
+    the stage timings of the current request are also kept per thread for its Server-Timing header
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    HELP = {
+        'fotos_request_seconds': 'Request latency by endpoint',
+        'fotos_db_query_seconds': 'Db query duration by query',
+    }
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        #(name, labels) -> [bucket counts, sum, count]
+        self._histograms = {}
+        #cache name -> function returning LruCache.stats()
+        self.caches = {}
+
+    def start_request(self):
+        self._local.timings = {}
+
+    def timings(self):
+        return getattr(self._local, 'timings', {})
+
+    def stage(self, name, seconds):
+        """adds seconds to the stage of the current request, a stage run several times is summed"""
+        timings = self.timings()
+        timings[name] = timings.get(name, 0) + seconds
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage(stage, time.perf_counter() - start)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def instrument(self, obj, methods):
+        """wraps the db methods to record their duration, as the db stage of the request and by query"""
+        for method in methods:
+            setattr(obj, method, self._instrumented(getattr(obj, method), method))
+
+    def _instrumented(self, fn, query):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.stage('db', elapsed)
+                self.observe('fotos_db_query_seconds', elapsed, query = query)
+        return wrapper
+
+    def server_timing(self, total):
+        """Server-Timing header value of the current request, durations in ms"""
+        stages = ['%s;dur=%.1f' % (name, seconds * 1000) for name, seconds in self.timings().items()]
+        return ', '.join(stages + ['total;dur=%.1f' % (total * 1000)])
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted((key, [list(h[0]), h[1], h[2]]) for key, h in self._histograms.items())
+        described = set()
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, self.HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            label = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+            prefix = label + ',' if label else ''
+            for bound, bucketCount in zip(self.BUCKETS, buckets):
+                lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, bucketCount))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, count))
+            lines.append('%s_sum{%s} %f' % (name, label, total))
+            lines.append('%s_count{%s} %d' % (name, label, count))
+
+        caches = sorted((name, stats()) for name, stats in self.caches.items())
+        for metric, kind, help in [('hits', 'counter', 'Cache hits'), ('misses', 'counter', 'Cache misses'),
+                ('size', 'gauge', 'Cached entries'), ('hit_rate', 'gauge', 'Cache hit rate since start')]:
+            name = 'fotos_cache_%s%s' % (metric, '_total' if kind == 'counter' else '')
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for cache, stats in caches:
+                lines.append('%s{cache="%s"} %s' % (name, cache, stats[metric]))
+        return '\n'.join(lines) + '\n'
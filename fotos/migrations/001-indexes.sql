@@ -0,0 +1,4 @@
+-- indexes for the photo and album lookups, album.name is already indexed by its unique constraint
+create index if not exists photo_album_file on photo (album_id, file);
+create index if not exists album_alias on album (alias);
+create index if not exists album_parent on album (parent_id);
@@ -0,0 +1,35 @@
+-- normalized tags, used by the security restriction instead of substring matching on the tags columns
+create table if not exists photo_tag (
+    photo_id INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (photo_id, tag)
+) without rowid;
+
+create table if not exists album_tag (
+    album_id INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (album_id, tag)
+) without rowid;
+
+create trigger if not exists photo_tag_delete after delete on photo begin
+    delete from photo_tag where photo_id = old.id;
+end;
+
+create trigger if not exists album_tag_delete after delete on album begin
+    delete from album_tag where album_id = old.id;
+end;
+
+-- split the existing comma joined tags
+with recursive split(id, tag, rest) as (
+    select id, '', tags || ',' from photo where tags is not null and tags != ''
+    union all
+    select id, trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1) from split where rest != ''
+)
+insert or ignore into photo_tag (photo_id, tag) select id, tag from split where tag != '';
+
+with recursive split(id, tag, rest) as (
+    select id, '', tags || ',' from album where tags is not null and tags != ''
+    union all
+    select id, trim(substr(rest, 1, instr(rest, ',') - 1)), substr(rest, instr(rest, ',') + 1) from split where rest != ''
+)
+insert or ignore into album_tag (album_id, tag) select id, tag from split where tag != '';
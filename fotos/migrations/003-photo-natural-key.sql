@@ -0,0 +1,4 @@
+-- photos are upserted by (album_id, file), drop duplicates before making the index unique
+delete from photo where id not in (select min(id) from photo group by album_id, file);
+drop index if exists photo_album_file;
+create unique index if not exists photo_album_file on photo (album_id, file);
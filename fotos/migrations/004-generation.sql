@@ -0,0 +1,6 @@
+-- bumped by every import, in process caches of all the wsgi processes compare it to drop stale entries
+create table if not exists generation (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    value INTEGER NOT NULL
+);
+insert or ignore into generation (id, value) values (1, 0);
@@ -0,0 +1,2 @@
+-- album photos are read in (date_time, id) order, pages continue after the last (date_time, id) seen
+create index if not exists photo_album_date on photo (album_id, date_time);
@@ -0,0 +1,2 @@
+-- widths of the responsive album image ladder generated for each photo, comma separated
+alter table photo add column widths TEXT;
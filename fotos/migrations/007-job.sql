@@ -0,0 +1,19 @@
+-- admin parse and import requests, run by the worker (fotos.py -a worker)
+create table if not exists job (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    action TEXT NOT NULL,
+    path TEXT NOT NULL,
+    force INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    album_name TEXT,
+    error TEXT,
+    processed INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    created REAL,
+    started REAL,
+    finished REAL
+);
+
+-- an album path is never queued or running twice
+create unique index if not exists job_active_path on job (path) where status in ('queued', 'running');
+create index if not exists job_status on job (status, id);
@@ -0,0 +1,7 @@
+-- folder snapshot of the library scanner (fotos.py -a scan): mtime, photo count and sub folders as json
+create table if not exists scan_dir (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    photos INTEGER NOT NULL,
+    subdirs TEXT NOT NULL
+);
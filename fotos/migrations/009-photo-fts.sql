@@ -0,0 +1,24 @@
+-- full text index over photo captions, tags, file names and album names, rowid is photo.id
+-- kept in sync by triggers on photo, so every import path updates it
+create virtual table if not exists photo_fts using fts5(caption, tags, file, album, tokenize = 'unicode61 remove_diacritics 2');
+
+create trigger if not exists photo_fts_insert after insert on photo begin
+    insert into photo_fts(rowid, caption, tags, file, album) values (new.id, 
+        replace(replace(new.caption, 'data-title="', ''), '"', ''), replace(new.tags, ',', ' '), new.file, 
+        (select name from album where id = new.album_id));
+end;
+
+create trigger if not exists photo_fts_update after update on photo begin
+    delete from photo_fts where rowid = old.id;
+    insert into photo_fts(rowid, caption, tags, file, album) values (new.id, 
+        replace(replace(new.caption, 'data-title="', ''), '"', ''), replace(new.tags, ',', ' '), new.file, 
+        (select name from album where id = new.album_id));
+end;
+
+create trigger if not exists photo_fts_delete after delete on photo begin
+    delete from photo_fts where rowid = old.id;
+end;
+
+insert into photo_fts(rowid, caption, tags, file, album) 
+    select photo.id, replace(replace(photo.caption, 'data-title="', ''), '"', ''), replace(photo.tags, ',', ' '), photo.file, album.name 
+    from photo left join album on album.id = photo.album_id;
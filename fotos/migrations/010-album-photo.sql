@@ -0,0 +1,22 @@
+-- photos of the virtual albums (album.custom_sql) materialized by Db.refresh_virtual_albums, in page order
+create table if not exists album_photo (
+    album_id INTEGER NOT NULL,
+    date_time TEXT,
+    photo_id INTEGER NOT NULL,
+    PRIMARY KEY (album_id, date_time, photo_id)
+) without rowid;
+
+create index if not exists album_photo_photo on album_photo (photo_id);
+
+create trigger if not exists album_photo_delete after delete on photo begin
+    delete from album_photo where photo_id = old.id;
+end;
+
+create trigger if not exists album_photo_album_delete after delete on album begin
+    delete from album_photo where album_id = old.id;
+end;
+
+-- last refresh of a virtual album: time, duration in ms and photo count
+alter table album add column refreshed REAL;
+alter table album add column refresh_ms REAL;
+alter table album add column photo_count INTEGER;
@@ -0,0 +1,16 @@
+-- justified layouts of the album photos computed at import (layout.py), one per viewport width
+-- and per set of restricted tags hiding photos from the viewer (hidden, sorted and comma separated, '' for none)
+-- positions is json {photo id: [x, y, width, height]}
+create table if not exists album_layout (
+    album_id INTEGER NOT NULL,
+    hidden TEXT NOT NULL,
+    viewport INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    positions TEXT,
+    PRIMARY KEY (album_id, hidden, viewport)
+) without rowid;
+
+create trigger if not exists album_layout_album_delete after delete on album begin
+    delete from album_layout where album_id = old.id;
+end;
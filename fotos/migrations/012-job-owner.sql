@@ -0,0 +1,4 @@
+-- pid of the process running a job, running jobs are requeued only once their owner is gone
+alter table job add column owner INTEGER;
+-- library root of the job path, set by the scanner which knows where it found the album
+alter table job add column base_path TEXT;
@@ -0,0 +1,2 @@
+-- error of the last refresh of a virtual album, null when its custom_sql worked
+alter table album add column refresh_error TEXT;
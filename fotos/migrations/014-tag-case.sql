@@ -0,0 +1,9 @@
+-- restricted tags match in any case: stored tags are trimmed and lower cased, rows colliding once lower cased are dropped
+update or ignore photo_tag set tag = lower(trim(tag)) where tag != lower(trim(tag));
+delete from photo_tag where tag != lower(trim(tag)) or tag = '';
+
+update or ignore album_tag set tag = lower(trim(tag)) where tag != lower(trim(tag));
+delete from album_tag where tag != lower(trim(tag)) or tag = '';
+
+-- layouts are keyed by the hidden tags, they are laid out again on first use
+delete from album_layout;
@@ -0,0 +1,89 @@
+import os
+
+class LibraryScanner:
+    """
+    finds the albums to parse below config paths by comparing folder mtimes with the snapshot of the previous scan
+    a folder whose mtime did not change is only stat-ed, its sub folders and photo count come from the snapshot
+    """
+    def __init__(self, config, logger, db) -> None:
+        self.config = config
+        self.logger = logger
+        self.db = db
+        self.skipDirs = [self.config["albumDir"], self.config["thumbDir"], 'js', 'css', 'default-skin', 'img']
+        self.formats = tuple(self.config["formats"])
+
+    def scan(self):
+        """
+        returns (base_path, path) of the albums which are new or changed since the previous scan
+        on the first scan only albums never parsed (without album.json) are returned
+        """
+        snapshot = self.db.load_scan_snapshot()
+        firstScan = len(snapshot) == 0
+        current = {}
+        changed = []
+        for basePath in self.config["paths"]:
+            self.walk(basePath.rstrip('/'), snapshot, current, changed)
+
+        albums = []
+        for basePath in self.config["paths"]:
+            basePath = basePath.rstrip('/')
+            roots = set()
+            for dirPath in changed:
+                if dirPath.startswith(basePath + os.sep):
+                    root = self.album_root(basePath, dirPath, current)
+                    if root and not (firstScan and self.is_parsed(root)):
+                        roots.add(root)
+            for root in sorted(roots):
+                #a parent album parses its sub folders too
+                if not any(root.startswith(other + os.sep) for other in roots):
+                    albums.append((basePath, os.path.relpath(root, basePath)))
+
+        #folders of the albums to parse are recorded by refresh once parsed, a failed parse is retried next scan
+        pending = [os.path.join(basePath, path) for basePath, path in albums]
+        done = {path: current[path] for path in changed if not any(path == root or path.startswith(root + os.sep) for root in pending)}
+        removed = [path for path in snapshot if path not in current]
+        self.db.save_scan_snapshot(done, removed)
+        self.logger.info("Scanned %d folders, %d changed, %d removed, %d albums to parse" % (len(current), len(changed), len(removed), len(albums)))
+        return albums
+
+    def walk(self, dirPath, snapshot, current, changed):
+        try:
+            mtime = os.stat(dirPath).st_mtime
+        except FileNotFoundError:
+            return
+        previous = snapshot.get(dirPath)
+        if previous and previous['mtime'] == mtime:
+            entry = previous
+        else:
+            subdirs = []
+            photos = 0
+            with os.scandir(dirPath) as it:
+                for e in it:
+                    if e.is_dir() and e.name not in self.skipDirs:
+                        subdirs.append(e.name)
+                    elif e.name.upper().endswith(self.formats):
+                        photos += 1
+            entry = {'mtime': mtime, 'photos': photos, 'subdirs': subdirs}
+            changed.append(dirPath)
+        current[dirPath] = entry
+        for d in entry['subdirs']:
+            self.walk(os.path.join(dirPath, d), snapshot, current, changed)
+
+    def album_root(self, basePath, dirPath, current):
+        """the top folder of the album containing dirPath: the highest folder with photos or an album.json"""
+        parts = os.path.relpath(dirPath, basePath).split(os.sep)
+        for i in range(1, len(parts) + 1):
+            path = os.path.join(basePath, *parts[:i])
+            if current.get(path, {}).get('photos') or self.is_parsed(path):
+                return path
+        return None
+
+    def is_parsed(self, path):
+        return os.path.isfile(os.path.join(path, self.config["albumDir"], self.config["albumDataFile"]))
+
+    def refresh(self, basePath, path):
+        """records the folders of a just parsed album, parsing changes their mtime"""
+        current = {}
+        changed = []
+        self.walk(os.path.join(basePath, path), {}, current, changed)
+        self.db.save_scan_snapshot(current, [])